@@ -0,0 +1,402 @@
+"""
+Нагрузочный бенчмарк бота против фейкового Telegram API (fake_telegram.py).
+
+Запуск:
+    python bench.py --users 100 --messages 200 --rate 50
+    python bench.py --latency 0.05 --retry-after-rate 0.01 --json result.json
+    python bench.py --filter 5000
+
+Бот стартует отдельным процессом в режиме вебхука (как в проде), фейковый API
+и генератор нагрузки — в этом процессе. Фазы:
+    join  — N пользователей делают /start;
+    chat  — сообщения (и фото) в общий чат, каждое уходит N-1 получателям;
+    dm    — /msg → выбор получателя → текст;
+    vote  — один опрос, голосует каждый пользователь.
+
+Задержка — от отправки апдейта в вебхук до запроса бота к API с этим
+сообщением (для vote — до answerCallbackQuery). Для каждой фазы печатаются
+p50/p90/p99/max и пропускная способность (доставок в секунду).
+По умолчанию лимиты Telegram и защита от флуда в боте сняты, чтобы мерить
+сам код; --telegram-limits оставляет боевые SEND_GLOBAL_RATE/SEND_CHAT_RATE/FLOOD_RATE.
+
+--filter N — без бота: фильтр триггеров из triggers.txt плюс N синтетических
+фраз; печатает время сборки автомата и стоимость проверки одного сообщения.
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+from fake_telegram import FakeTelegram
+
+
+TOKEN = "123:bench"
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+MARK = re.compile(r"bench:(\d+)")
+QUIET_PERIOD = 0.5      # сек без запросов к API — фаза досчиталась
+POLL_QUIET_PERIOD = 2.0 # больше POLL_EDIT_DELAY бота, чтобы дождаться правок опроса
+PHASE_TIMEOUT = 300.0
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def percentile(values: list, q: float) -> float:
+    """Перцентиль по ближайшему рангу; values отсортирован."""
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(q / 100 * len(values)) - 1))]
+
+
+def parse_metrics(text: str) -> dict:
+    """Строки Prometheus без HELP/TYPE и бакетов: { "имя{метки}": значение }."""
+    result = {}
+    for line in text.splitlines():
+        if not line or line.startswith("#") or "_bucket{" in line:
+            continue
+        name, _, value = line.rpartition(" ")
+        result[name] = float(value)
+    return result
+
+
+class Bench:
+    def __init__(self, args):
+        self.args = args
+        self.fake = FakeTelegram(TOKEN, port=0, latency=args.latency,
+                                 retry_after_rate=args.retry_after_rate)
+        self.bot_port = free_port()
+        self.proc = None
+        self.workdir = None
+        self.http = None
+        self.seq = 0
+        self.pushed = {}       # { seq: время отправки апдейта }
+        self.results = {}      # { фаза: {...} }
+
+    # --------------------------------------------------------------------
+    # Бот и фейковый API
+    # --------------------------------------------------------------------
+    def bot_env(self) -> dict:
+        env = dict(os.environ)
+        env.update({
+            "token_an": TOKEN,
+            "TELEGRAM_BASE_URL": self.fake.base_url,
+            "BOT_MODE": "webhook",
+            "WEBHOOK_URL": f"http://127.0.0.1:{self.bot_port}",
+            "PORT": str(self.bot_port),
+            "STATE_BACKEND": "memory",
+            "OUTBOX_DB": ":memory:",
+            "SEND_WORKERS": str(self.args.workers),
+        })
+        if not self.args.telegram_limits:
+            env["SEND_GLOBAL_RATE"] = "1000000"
+            env["SEND_CHAT_RATE"] = "1000"
+            env["FLOOD_RATE"] = "0"
+        return env
+
+    async def start(self):
+        await self.fake.start()
+        self.workdir = tempfile.TemporaryDirectory(prefix="bench-")
+        self.stderr = open(os.path.join(self.workdir.name, "stderr.log"), "w")
+        self.proc = subprocess.Popen(
+            [sys.executable, MAIN], env=self.bot_env(), cwd=self.workdir.name,
+            stdout=subprocess.DEVNULL, stderr=self.stderr
+        )
+        self.http = httpx.AsyncClient(timeout=10)
+        try:
+            await asyncio.wait_for(self.fake.webhook_set.wait(), 30)
+        except asyncio.TimeoutError:
+            raise RuntimeError(f"Бот не поставил вебхук, см. {self.stderr.name}")
+
+    async def stop(self):
+        if self.proc and self.proc.poll() is None:
+            self.proc.send_signal(signal.SIGTERM)
+            try:
+                self.proc.wait(15)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+        if self.http:
+            await self.http.aclose()
+        await self.fake.stop()
+        if self.workdir:
+            self.stderr.close()
+            self.workdir.cleanup()
+
+    async def bot_metrics(self) -> dict:
+        r = await self.http.get(f"http://127.0.0.1:{self.bot_port}/metrics")
+        return parse_metrics(r.text)
+
+    async def drain(self, quiet: float = QUIET_PERIOD):
+        """Ждём, пока очередь бота опустеет и API перестанут дёргать."""
+        deadline = time.monotonic() + PHASE_TIMEOUT
+        while time.monotonic() < deadline:
+            await asyncio.sleep(QUIET_PERIOD / 2)
+            if self.proc.poll() is not None:
+                raise RuntimeError(f"Бот завершился, см. {self.stderr.name}")
+            calls = self.fake.calls
+            if calls and time.monotonic() - calls[-1][0] < quiet:
+                continue
+            if (await self.bot_metrics()).get("bot_outbox_queue_depth", 0) == 0:
+                return
+        raise RuntimeError("Фаза не завершилась за отведённое время")
+
+    # --------------------------------------------------------------------
+    # Нагрузка
+    # --------------------------------------------------------------------
+    def mark(self) -> str:
+        self.seq += 1
+        return f"bench:{self.seq}"
+
+    async def push(self, update: dict, seq: int = None):
+        if seq is not None:
+            self.pushed[seq] = time.monotonic()
+        await self.fake.push(update)
+
+    async def paced(self, items: list, rate: float):
+        """Запускаем корутины items с частотой rate в секунду, не дожидаясь каждой."""
+        started = time.monotonic()
+        tasks = []
+        for i, make in enumerate(items):
+            delay = started + i / rate - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            tasks.append(asyncio.create_task(make()))
+        await asyncio.gather(*tasks)
+
+    async def run_phase(self, name: str, scenario, collect, quiet: float = QUIET_PERIOD):
+        """Прогнать фазу и посчитать задержки по запросам к API после её начала."""
+        first_call = len(self.fake.calls)
+        started = time.monotonic()
+        await scenario()
+        await self.drain(quiet)
+        calls = self.fake.calls[first_call:]
+        latencies = collect(calls)
+        finished = calls[-1][0] if calls else time.monotonic()
+        self.report(name, latencies, finished - started, len(calls))
+
+    def report(self, name: str, latencies: list, duration: float, api_calls: int):
+        latencies.sort()
+        self.results[name] = {
+            "count": len(latencies),
+            "api_calls": api_calls,
+            "duration_s": round(duration, 3),
+            "throughput_per_s": round(len(latencies) / duration, 1) if duration > 0 else 0.0,
+            "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+            "p90_ms": round(percentile(latencies, 90) * 1000, 2),
+            "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+            "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        }
+
+    def marked_latencies(self, calls: list, methods: tuple) -> list:
+        latencies = []
+        for t, method, params in calls:
+            if method not in methods:
+                continue
+            m = MARK.search(params.get("text") or params.get("caption") or "")
+            if m and int(m.group(1)) in self.pushed:
+                latencies.append(t - self.pushed[int(m.group(1))])
+        return latencies
+
+    async def phase_join(self):
+        users = self.users
+        joined = {}
+
+        async def scenario():
+            async def join(uid):
+                joined[uid] = time.monotonic()
+                await self.push(self.fake.message_update(uid, "/start"))
+            await self.paced([lambda uid=uid: join(uid) for uid in users], self.args.rate)
+
+        def collect(calls):
+            latencies = []
+            for t, method, params in calls:
+                uid = params.get("chat_id")
+                if method == "sendMessage" and uid in joined and "Твой ник" in params.get("text", ""):
+                    latencies.append(t - joined.pop(uid))
+            return latencies
+
+        await self.run_phase("join", scenario, collect)
+
+    async def phase_chat(self):
+        def message():
+            uid = random.choice(self.users)
+            text = self.mark()
+            seq = self.seq
+            if random.random() < self.args.photo_share:
+                update = self.fake.media_update(uid, "photo", f"photo{seq}", caption=text)
+            else:
+                update = self.fake.message_update(uid, f"{text} привет всем")
+            return lambda: self.push(update, seq)
+
+        async def scenario():
+            await self.paced([message() for _ in range(self.args.messages)], self.args.rate)
+
+        await self.run_phase("chat", scenario,
+                             lambda calls: self.marked_latencies(calls, ("sendMessage", "sendPhoto")))
+
+    async def phase_dm(self):
+        async def dm(sender, recipient):
+            # Шаги одного диалога идут по порядку, разные диалоги — параллельно
+            await self.push(self.fake.message_update(sender, "/msg"))
+            await self.push(self.fake.callback_update(sender, f"msg_select|{recipient}"))
+            text = self.mark()
+            await self.push(self.fake.message_update(sender, text), self.seq)
+
+        def pair():
+            sender, recipient = random.sample(self.users, 2)
+            return lambda: dm(sender, recipient)
+
+        async def scenario():
+            await self.paced([pair() for _ in range(self.args.dms)], self.args.rate)
+
+        await self.run_phase("dm", scenario, lambda calls: self.marked_latencies(calls, ("sendMessage",)))
+
+    async def phase_vote(self):
+        creator = self.users[0]
+        await self.push(self.fake.message_update(creator, "/poll"))
+        await self.push(self.fake.message_update(creator, "Бенчмарк?\nДа\nНет\nНе знаю"))
+        await self.drain()
+        voted = {}
+        markup = next(params["reply_markup"] for _, method, params in reversed(self.fake.calls)
+                      if method == "sendMessage" and params.get("reply_markup"))
+        poll_id = markup["inline_keyboard"][0][0]["callback_data"].split("|")[1]
+
+        async def vote(uid):
+            update = self.fake.callback_update(uid, f"pv|{poll_id}|{random.randint(1, 3)}")
+            voted[update["callback_query"]["id"]] = time.monotonic()
+            await self.push(update)
+
+        async def scenario():
+            await self.paced([lambda uid=uid: vote(uid) for uid in self.users], self.args.rate)
+
+        def collect(calls):
+            latencies = []
+            for t, method, params in calls:
+                if method == "answerCallbackQuery" and params.get("callback_query_id") in voted:
+                    latencies.append(t - voted.pop(params["callback_query_id"]))
+            self.poll_edits = sum(1 for _, method, _ in calls if method == "editMessageText")
+            return latencies
+
+        await self.run_phase("vote", scenario, collect, POLL_QUIET_PERIOD)
+
+    async def run(self):
+        self.users = list(range(1, self.args.users + 1))
+        await self.start()
+        try:
+            await self.phase_join()
+            await self.phase_chat()
+            await self.phase_dm()
+            await self.phase_vote()
+            self.metrics = await self.bot_metrics()
+        finally:
+            await self.stop()
+
+    def print_report(self):
+        print(f"\nПользователей: {self.args.users}, частота апдейтов: {self.args.rate}/с, "
+              f"задержка API: {self.args.latency * 1000:.0f} мс, "
+              f"доля 429: {self.args.retry_after_rate:.1%}")
+        print(f"{'фаза':<6}{'доставок':>10}{'сек':>9}{'в сек':>10}"
+              f"{'p50 мс':>10}{'p90 мс':>10}{'p99 мс':>10}{'max мс':>10}")
+        for name, r in self.results.items():
+            print(f"{name:<6}{r['count']:>10}{r['duration_s']:>9.2f}{r['throughput_per_s']:>10.1f}"
+                  f"{r['p50_ms']:>10.1f}{r['p90_ms']:>10.1f}{r['p99_ms']:>10.1f}{r['max_ms']:>10.1f}")
+        print(f"Правок опроса: {self.poll_edits}")
+        sends = {k: int(v) for k, v in self.metrics.items() if k.startswith("bot_send_total")}
+        print("Отправки бота: " + ", ".join(f"{k[k.index('=') + 2:-2]}={v}" for k, v in sends.items()))
+
+
+FILTER_SAMPLES = [
+    "Привет всем, как прошёл день?",
+    "Сегодня наконец-то нормально поела и не ругала себя",
+    "Вешу 48,5 кг, а хочу 45",
+    "Кто-нибудь ходил к психотерапевту по ОМС? Поделитесь опытом",
+    "Опять считала калории весь вечер, устала от этого",
+    "Держитесь, вы все молодцы. Я рядом, если что — пишите в личку",
+    "Погода отличная, вышла погулять в парк и стало чуть легче",
+]
+
+
+def bench_filter(patterns: int, rounds: int):
+    """Сборка автомата и проход по сообщениям — в этом процессе, без бота."""
+    sys.path.insert(0, os.path.dirname(MAIN))
+    import main as bot
+
+    entries = bot.load_trigger_entries(bot.TRIGGERS_FILE)
+    alphabet = "абвгдежзиклмнопрстуфхцчшщыэюя"
+    rng = random.Random(1)
+    for _ in range(patterns):
+        words = ("".join(rng.choice(alphabet) for _ in range(rng.randint(4, 9)))
+                 for _ in range(rng.randint(1, 3)))
+        entries.append((rng.choice(bot.TRIGGER_ACTIONS), " ".join(words) + rng.choice(("", "*"))))
+    started = time.perf_counter()
+    automaton = bot.TriggerAutomaton(entries)
+    build_ms = (time.perf_counter() - started) * 1000
+
+    samples = FILTER_SAMPLES + [" ".join(FILTER_SAMPLES)]
+    per_message = []
+    for text in samples:
+        started = time.perf_counter()
+        for _ in range(rounds):
+            automaton.scan(text)
+        per_message.append((text, (time.perf_counter() - started) / rounds * 1e6))
+    print(f"Фраз: {len(entries)}, сборка автомата: {build_ms:.1f} мс")
+    print(f"{'символов':>9}{'мкс':>9}{'действие':>10}  сообщение")
+    for text, us in per_message:
+        match = automaton.scan(text)
+        print(f"{len(text):>9}{us:>9.1f}{(match.action if match else '-'):>10}  {text[:50]}")
+    total_chars = sum(len(t) for t in samples)
+    total_us = sum(us for _, us in per_message)
+    print(f"В среднем: {total_us / len(samples):.1f} мкс на сообщение, "
+          f"{total_us * 1000 / total_chars:.0f} нс на символ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный бенчмарк бота")
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--messages", type=int, default=200, help="сообщений в общий чат")
+    parser.add_argument("--dms", type=int, default=50, help="личных сообщений")
+    parser.add_argument("--rate", type=float, default=50, help="апдейтов в секунду")
+    parser.add_argument("--photo-share", type=float, default=0.1, help="доля фото среди сообщений")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка ответа API, сек")
+    parser.add_argument("--retry-after-rate", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--workers", type=int, default=16, help="SEND_WORKERS бота")
+    parser.add_argument("--telegram-limits", action="store_true", help="не снимать лимиты отправки")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", help="записать результаты в файл")
+    parser.add_argument("--filter", type=int, metavar="N",
+                        help="замерить фильтр триггеров с N синтетическими фразами и выйти")
+    parser.add_argument("--max-chat-p99", type=float, default=0.0,
+                        help="мс; если p99 фазы chat выше — код выхода 1")
+    args = parser.parse_args()
+    if args.filter is not None:
+        bench_filter(args.filter, rounds=2000)
+        return
+    if args.users < 2:
+        parser.error("--users должно быть не меньше 2")
+    random.seed(args.seed)
+
+    bench = Bench(args)
+    asyncio.run(bench.run())
+    bench.print_report()
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump({"args": vars(args), "phases": bench.results}, f, ensure_ascii=False, indent=2)
+    if args.max_chat_p99 and bench.results["chat"]["p99_ms"] > args.max_chat_p99:
+        print(f"p99 фазы chat {bench.results['chat']['p99_ms']} мс > {args.max_chat_p99} мс")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
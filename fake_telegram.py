@@ -0,0 +1,321 @@
+"""
+Фейковый Telegram Bot API для локальной проверки бота без настоящего Telegram.
+
+Запуск:
+    python fake_telegram.py --port 8081
+
+Бот в режиме вебхука против него:
+    token_an=123:fake TELEGRAM_BASE_URL=http://127.0.0.1:8081/bot \\
+    BOT_MODE=webhook WEBHOOK_URL=http://127.0.0.1:8080 PORT=8080 python main.py
+
+Как только бот вызовет setWebhook, сценарий --demo отправит ему несколько
+апдейтов (вход, сообщение, выход) и напечатает всё, что бот отправил в ответ.
+Без вебхука апдейты отдаются через getUpdates, так что режим polling тоже работает.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import random
+import time
+from urllib.parse import parse_qsl
+
+import httpx
+
+from webserver import HttpServer, Response
+
+
+JSON_KEYS = {"reply_markup", "media", "commands", "allowed_updates", "entities"}
+INT_KEYS = {"chat_id", "message_id", "reply_to_message_id", "offset", "limit", "timeout", "user_id"}
+SEND_METHODS = {
+    "sendMessage", "sendPhoto", "sendSticker", "sendVoice", "sendVideo",
+    "sendAnimation", "sendDocument", "sendAudio", "sendVideoNote",
+}
+
+
+def parse_params(request) -> dict:
+    """PTB шлёт form-urlencoded, где не-строковые значения — JSON."""
+    if request.headers.get("content-type", "").startswith("application/json"):
+        return json.loads(request.body or b"{}")
+    params = {}
+    for key, value in parse_qsl(request.body.decode("utf-8"), keep_blank_values=True):
+        if key in JSON_KEYS:
+            value = json.loads(value)
+        elif key in INT_KEYS:
+            value = int(value)
+        params[key] = value
+    return params
+
+
+class FakeTelegram:
+    """
+    Эмулирует нужную боту часть Bot API: getMe, setWebhook/deleteWebhook,
+    getUpdates, setMyCommands, send*/sendMediaGroup, edit*, answerCallbackQuery.
+
+    latency — задержка ответа (сек), retry_after_rate — доля запросов на отправку,
+    на которые отвечаем 429 RetryAfter с retry_after секунд.
+    """
+
+    BOT_ID = 100000
+
+    def __init__(self, token: str, host: str = "127.0.0.1", port: int = 8081,
+                 latency: float = 0.0, retry_after_rate: float = 0.0, retry_after: int = 1):
+        self.token = token
+        self.server = HttpServer(host, port)
+        self.latency = latency
+        self.retry_after_rate = retry_after_rate
+        self.retry_after = retry_after
+        self.webhook_url = ""
+        self.webhook_secret = ""
+        self.webhook_set = asyncio.Event()
+        self.updates = asyncio.Queue()
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.calls = []        # [(время, метод, параметры)]
+        self.sent = {}         # { chat_id: [отправленные в чат сообщения] }
+        self.listeners = []    # callback(method, params, t) на каждую успешную отправку/правку
+        self.client = None
+        for method in (
+            "getMe", "setWebhook", "deleteWebhook", "getUpdates", "setMyCommands",
+            "answerCallbackQuery", "sendMediaGroup", "editMessageText",
+            "editMessageReplyMarkup", "deleteMessage", *SEND_METHODS,
+        ):
+            self.server.route("POST", f"/bot{token}/{method}", self._endpoint(method))
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.server.host}:{self.server.port}/bot"
+
+    async def start(self):
+        self.client = httpx.AsyncClient(timeout=10)
+        await self.server.start()
+
+    async def stop(self):
+        await self.server.stop()
+        if self.client:
+            await self.client.aclose()
+
+    # --------------------------------------------------------------------
+    # Bot API
+    # --------------------------------------------------------------------
+    def _endpoint(self, method: str):
+        async def handler(request):
+            params = parse_params(request)
+            if self.latency:
+                await asyncio.sleep(self.latency)
+            if (method in SEND_METHODS or method.startswith("edit")) and \
+                    self.retry_after_rate and random.random() < self.retry_after_rate:
+                return self._reply(
+                    {"ok": False, "error_code": 429,
+                     "description": f"Too Many Requests: retry after {self.retry_after}",
+                     "parameters": {"retry_after": self.retry_after}},
+                    status=429
+                )
+            now = time.monotonic()
+            self.calls.append((now, method, params))
+            result = await getattr(self, f"_api_{method}", self._api_send)(method, params)
+            if method in SEND_METHODS or method.startswith("edit") or method == "sendMediaGroup":
+                for listener in self.listeners:
+                    listener(method, params, now)
+            return self._reply({"ok": True, "result": result})
+        return handler
+
+    @staticmethod
+    def _reply(payload: dict, status: int = 200):
+        return Response(json.dumps(payload), status, "application/json")
+
+    def _message(self, chat_id: int, params: dict, message_id: int = None) -> dict:
+        msg = {
+            "message_id": message_id or next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": {"id": self.BOT_ID, "is_bot": True, "first_name": "FakeBot"},
+        }
+        for key in ("text", "caption"):
+            if key in params:
+                msg[key] = params[key]
+        if "photo" in params:
+            msg["photo"] = [{"file_id": params["photo"], "file_unique_id": params["photo"],
+                             "width": 1, "height": 1}]
+        if "sticker" in params:
+            msg["sticker"] = {"file_id": params["sticker"], "file_unique_id": params["sticker"],
+                              "type": "regular", "width": 1, "height": 1,
+                              "is_animated": False, "is_video": False}
+        if "reply_markup" in params:
+            msg["reply_markup"] = params["reply_markup"]
+        return msg
+
+    async def _api_getMe(self, method, params):
+        return {"id": self.BOT_ID, "is_bot": True, "first_name": "FakeBot", "username": "fake_bot",
+                "can_join_groups": False, "can_read_all_group_messages": False,
+                "supports_inline_queries": False}
+
+    async def _api_setWebhook(self, method, params):
+        self.webhook_url = params["url"]
+        self.webhook_secret = params.get("secret_token", "")
+        self.webhook_set.set()
+        return True
+
+    async def _api_deleteWebhook(self, method, params):
+        self.webhook_url = ""
+        self.webhook_set.clear()
+        return True
+
+    async def _api_getUpdates(self, method, params):
+        try:
+            first = await asyncio.wait_for(self.updates.get(), params.get("timeout") or 0.1)
+        except asyncio.TimeoutError:
+            return []
+        batch = [first]
+        while not self.updates.empty():
+            batch.append(self.updates.get_nowait())
+        return batch
+
+    async def _api_setMyCommands(self, method, params):
+        return True
+
+    async def _api_answerCallbackQuery(self, method, params):
+        return True
+
+    async def _api_deleteMessage(self, method, params):
+        return True
+
+    async def _api_send(self, method, params):
+        msg = self._message(params["chat_id"], params)
+        if "reply_to_message_id" in params:
+            msg["reply_to_message"] = {"message_id": params["reply_to_message_id"]}
+        self.sent.setdefault(params["chat_id"], []).append(msg)
+        return msg
+
+    async def _api_sendMediaGroup(self, method, params):
+        return [self._message(params["chat_id"], {"caption": m.get("caption", "")})
+                for m in params["media"]]
+
+    async def _api_editMessageText(self, method, params):
+        return self._message(params["chat_id"], params, params["message_id"])
+
+    async def _api_editMessageReplyMarkup(self, method, params):
+        return self._message(params["chat_id"], params, params["message_id"])
+
+    # --------------------------------------------------------------------
+    # Апдейты «от пользователей»
+    # --------------------------------------------------------------------
+    @staticmethod
+    def _user(user_id: int) -> dict:
+        return {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+
+    def message_update(self, user_id: int, text: str, reply_to: dict = None) -> dict:
+        msg = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": self._user(user_id),
+            "text": text,
+        }
+        if text.startswith("/"):
+            command = text.split()[0]
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(command)}]
+        if reply_to:
+            msg["reply_to_message"] = reply_to
+        return {"update_id": next(self.update_ids), "message": msg}
+
+    def media_update(self, user_id: int, kind: str, file_id: str, caption: str = "",
+                     media_group_id: str = None) -> dict:
+        """Сообщение с вложением: kind — photo, video, sticker, voice..."""
+        update = self.message_update(user_id, "")
+        msg = update["message"]
+        del msg["text"]
+        media = {"file_id": file_id, "file_unique_id": file_id}
+        if kind == "photo":
+            msg["photo"] = [dict(media, width=1, height=1)]
+        elif kind == "sticker":
+            msg["sticker"] = dict(media, type="regular", width=1, height=1,
+                                  is_animated=False, is_video=False)
+        elif kind in ("video", "animation"):
+            msg[kind] = dict(media, width=1, height=1, duration=1)
+        elif kind == "video_note":
+            msg[kind] = dict(media, length=1, duration=1)
+        elif kind in ("voice", "audio"):
+            msg[kind] = dict(media, duration=1)
+        else:
+            msg[kind] = media
+        if caption:
+            msg["caption"] = caption
+        if media_group_id:
+            msg["media_group_id"] = media_group_id
+        return update
+
+    def callback_update(self, user_id: int, data: str, message_id: int = 1) -> dict:
+        return {
+            "update_id": next(self.update_ids),
+            "callback_query": {
+                "id": str(next(self.update_ids)),
+                "from": self._user(user_id),
+                "chat_instance": str(user_id),
+                "data": data,
+                "message": {
+                    "message_id": message_id,
+                    "date": int(time.time()),
+                    "chat": {"id": user_id, "type": "private"},
+                    "from": {"id": self.BOT_ID, "is_bot": True, "first_name": "FakeBot"},
+                    "text": "...",
+                },
+            },
+        }
+
+    async def push(self, update: dict):
+        """Доставить апдейт боту: вебхуком, если он задан, иначе через getUpdates."""
+        if not self.webhook_url:
+            await self.updates.put(update)
+            return
+        r = await self.client.post(
+            self.webhook_url,
+            json=update,
+            headers={"X-Telegram-Bot-Api-Secret-Token": self.webhook_secret}
+        )
+        if r.status_code != 200:
+            logging.warning(f"Вебхук ответил {r.status_code}: {r.text}")
+
+
+async def demo(fake: FakeTelegram):
+    print(f"Фейковый API: {fake.base_url}. Ждём setWebhook от бота...")
+    await fake.webhook_set.wait()
+    print(f"Вебхук: {fake.webhook_url}")
+    fake.listeners.append(lambda method, params, t: print(f"  -> {method} {params.get('chat_id')}: "
+                                                          f"{params.get('text') or params.get('caption')}"))
+    for update in (
+        fake.message_update(1, "/start"),
+        fake.message_update(2, "/start"),
+        fake.message_update(1, "Привет всем!"),
+        fake.message_update(2, "/stop"),
+    ):
+        await fake.push(update)
+        await asyncio.sleep(1.5)
+    print("Готово.")
+
+
+async def serve(args):
+    fake = FakeTelegram(args.token, port=args.port, latency=args.latency,
+                        retry_after_rate=args.retry_after_rate)
+    await fake.start()
+    try:
+        if args.demo:
+            await demo(fake)
+        await asyncio.Event().wait()
+    finally:
+        await fake.stop()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Фейковый Telegram Bot API")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--token", default="123:fake")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--retry-after-rate", type=float, default=0.0)
+    parser.add_argument("--demo", action="store_true")
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(serve(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
@@ -1,18 +1,49 @@
+import time
+BOOT_STARTED = time.monotonic()   # до остальных импортов: они тоже входят во время старта
+
 import os
 import logging
 import random
 import datetime
 import re
-
-from flask import Flask
-from threading import Thread
+import collections
+import heapq
+import json
+import asyncio
+import sqlite3
+import threading
+import signal
+import secrets
+import hmac
+import hashlib
+import array
+import bisect
+import functools
+import itertools
+import queue
+import copy
+import atexit
+import logging.handlers
 
 from telegram import (
+    Bot,
     Update,
     BotCommand,
     InlineKeyboardMarkup,
-    InlineKeyboardButton
+    InlineKeyboardButton,
+    InputMediaAudio,
+    InputMediaDocument,
+    InputMediaPhoto,
+    InputMediaVideo
+)
+from telegram.error import (
+    BadRequest,
+    Forbidden,
+    NetworkError,
+    RetryAfter,
+    TimedOut
 )
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -25,52 +56,350 @@ from telegram.ext import (
 
 
 # ------------------------------------------------------------------------
-# 1) ЧТЕНИЕ TOKEN ИЗ ОКРУЖЕНИЯ
+# 1) ЧТЕНИЕ TOKEN ИЗ ОКРУЖЕНИЯ (проверяется в main())
 # ------------------------------------------------------------------------
+# Импорт модуля только объявляет: токен, логирование, состояние, журнал
+# отправки и сервер поднимает main() (доставщики — run_delivery_shard()).
 BOT_TOKEN = os.getenv("token_an")
-if not BOT_TOKEN:
-    raise ValueError("No token_an found in environment variables!")
+
+BOT_MODE = os.getenv("BOT_MODE", "polling")            # polling | webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")             # публичный адрес, напр. https://xxx.up.railway.app
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")       # пусто — сгенерируем при старте
+TELEGRAM_BASE_URL = os.getenv("TELEGRAM_BASE_URL", "") # для фейкового API, напр. http://127.0.0.1:8081/bot
 
 
 # ------------------------------------------------------------------------
 # 2) FLASK (мини-сервер) - KEEP ALIVE
 # ------------------------------------------------------------------------
-flask_app = Flask(__name__)
+# Flask нужен только в режиме polling — импортируем при запуске, а не при загрузке модуля.
+def build_flask_app():
+    from flask import Flask
 
-@flask_app.route('/')
-def home():
-    return "Я жив!"
+    flask_app = Flask(__name__)
 
-def run_server():
-    port = int(os.getenv("PORT", "8080"))  # Railway provides PORT
-    flask_app.run(host='0.0.0.0', port=port)
+    @flask_app.route('/')
+    def home():
+        return "Я жив!"
+
+    @flask_app.route('/metrics')
+    def metrics_page():
+        return metrics.render(), 200, {"Content-Type": METRICS_CONTENT_TYPE}
+
+    return flask_app
 
 def keep_alive():
-    t = Thread(target=run_server)
-    t.start()
+    """Flask в фоновом потоке; вернёт сервер, чтобы остановить его через shutdown()."""
+    from werkzeug.serving import make_server
+
+    port = int(os.getenv("PORT", "8080"))  # Railway provides PORT
+    server = make_server("0.0.0.0", port, build_flask_app(), threaded=True)
+    threading.Thread(target=server.serve_forever, name="keep-alive", daemon=True).start()
+    return server
 
 
 # ------------------------------------------------------------------------
 # 3) ЛОГИРОВАНИЕ
 # ------------------------------------------------------------------------
-logging.basicConfig(
-    filename='bot.log',
-    level=logging.INFO,
-    format='%(asctime)s [%(levelname)s] %(name)s: %(message)s'
-)
+# Запись в файл — в отдельном потоке: хендлеры и воркеры только кладут запись в очередь.
+LOG_FILE = os.getenv("LOG_FILE", "bot.log")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")                       # json | text
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUPS = int(os.getenv("LOG_BACKUPS", "5"))
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "")                 # "midnight", "H"... — по времени вместо размера
+LOG_AGGREGATE_INTERVAL = float(os.getenv("LOG_AGGREGATE_INTERVAL", "10"))  # сек между сводками ошибок
+LOG_SAMPLES = 5                                                    # примеров получателей в сводке
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись — одна строка JSON. Доп. поля — через extra={"fields": {...}}."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Как QueueHandler, но трейсбек остаётся отдельно от текста (поле exc в JSON)."""
+    _exc_formatter = logging.Formatter()
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        exc_text = record.exc_text
+        if record.exc_info and not exc_text:
+            exc_text = self._exc_formatter.formatException(record.exc_info)
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        record.exc_info = None
+        record.exc_text = exc_text
+        return record
+
+
+log_listener = None
+
+def setup_logging(filename: str = LOG_FILE):
+    """
+    Корневой логгер -> очередь -> поток-писатель с ротацией. Повторный вызов меняет файл.
+    Вызывается из main() и run_delivery_shard(), не при импорте: import main
+    (bench.py --filter, процессы-доставщики) не трогает чужое логирование.
+    """
+    global log_listener
+    if LOG_ROTATE_WHEN:
+        file_handler = logging.handlers.TimedRotatingFileHandler(
+            filename, when=LOG_ROTATE_WHEN, backupCount=LOG_BACKUPS, encoding="utf-8"
+        )
+    else:
+        file_handler = logging.handlers.RotatingFileHandler(
+            filename, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUPS, encoding="utf-8"
+        )
+    if LOG_FORMAT == "json":
+        file_handler.setFormatter(JsonFormatter())
+    else:
+        file_handler.setFormatter(logging.Formatter("%(asctime)s [%(levelname)s] %(name)s: %(message)s"))
+
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    if log_listener:
+        log_listener.stop()
+    else:
+        atexit.register(lambda: log_listener and log_listener.stop())
+    log_queue = queue.SimpleQueue()
+    root.addHandler(LogQueueHandler(log_queue))
+    root.setLevel(logging.INFO)
+    log_listener = logging.handlers.QueueListener(log_queue, file_handler)
+    log_listener.start()
+
+
+class LogAggregator:
+    """
+    Сводка повторяющихся ошибок: одинаковые (событие, ошибка) за
+    LOG_AGGREGATE_INTERVAL дают одну запись с числом и примерами получателей.
+    Рассылка на 1000 заблокировавших бота — одна строка, а не 1000.
+    """
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self.pending = {}    # { (событие, ошибка): [число, [примеры]] }
+        self.handle = None
+
+    def add(self, event: str, error, label: str = ""):
+        key = (event, str(error)[:200])
+        entry = self.pending.get(key)
+        if entry is None:
+            entry = self.pending[key] = [0, []]
+        entry[0] += 1
+        if label and len(entry[1]) < LOG_SAMPLES:
+            entry[1].append(label)
+        if self.handle is None:
+            try:
+                self.handle = asyncio.get_running_loop().call_later(self.interval, self.flush)
+            except RuntimeError:
+                self.flush()
+
+    def flush(self):
+        self.handle = None
+        pending, self.pending = self.pending, {}
+        for (event, error), (count, samples) in pending.items():
+            logging.warning(
+                f"{event} ×{count}: {error}" + (f" (напр. {', '.join(samples)})" if samples else ""),
+                extra={"fields": {"event": event, "error": error, "count": count, "samples": samples}}
+            )
+
+    def close(self):
+        if self.handle:
+            self.handle.cancel()
+        self.flush()
+
+
+send_errors = LogAggregator(LOG_AGGREGATE_INTERVAL)
+
+
+# ------------------------------------------------------------------------
+# 3.1) МЕТРИКИ (Prometheus, GET /metrics)
+# ------------------------------------------------------------------------
+METRICS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+FANOUT_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+class Counter:
+    """Счётчик. inc() — одно сложение: без блокировок, всё пишется из цикла asyncio."""
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, n: int = 1):
+        self.value += n
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами; кумулятивные суммы — только при выгрузке."""
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: tuple):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)   # последняя ячейка — +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class MetricsRegistry:
+    """
+    Реестр метрик в текстовом формате Prometheus.
+    Счётчики и гистограммы создаются заранее (с метками) и на горячем пути
+    только увеличиваются; гауги — функции, их считаем при выгрузке.
+    """
+
+    def __init__(self):
+        self.families = {}   # { имя: (тип, описание, { "метки": Counter | Histogram }) }
+        self.gauges = []     # [(имя, описание, fn)]
+
+    def _child(self, kind: str, name: str, doc: str, labels: dict, factory):
+        family = self.families.setdefault(name, (kind, doc, {}))[2]
+        key = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+        if key not in family:
+            family[key] = factory()
+        return family[key]
+
+    def counter(self, name: str, doc: str, **labels) -> Counter:
+        return self._child("counter", name, doc, labels, Counter)
+
+    def histogram(self, name: str, doc: str, buckets: tuple = LATENCY_BUCKETS, **labels) -> Histogram:
+        return self._child("histogram", name, doc, labels, lambda: Histogram(buckets))
+
+    def gauge(self, name: str, doc: str, fn):
+        self.gauges.append((name, doc, fn))
+
+    def render(self) -> str:
+        lines = []
+        for name, (kind, doc, family) in list(self.families.items()):
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} {kind}")
+            for key, child in list(family.items()):
+                if kind == "counter":
+                    lines.append(f"{name}{{{key}}} {child.value}" if key else f"{name} {child.value}")
+                    continue
+                prefix = key + "," if key else ""
+                total = 0
+                for bound, count in zip(child.bounds + ("+Inf",), list(child.counts)):
+                    total += count
+                    lines.append(f'{name}_bucket{{{prefix}le="{bound}"}} {total}')
+                suffix = f"{{{key}}}" if key else ""
+                lines.append(f"{name}_sum{suffix} {child.sum}")
+                lines.append(f"{name}_count{suffix} {total}")
+        for name, doc, fn in self.gauges:
+            try:
+                value = fn()
+            except Exception as e:
+                logging.warning(f"Метрика {name} не посчиталась: {e}")
+                continue
+            lines.append(f"# HELP {name} {doc}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+
+metrics = MetricsRegistry()
+
+# Гауги считаются при выгрузке, поэтому могут ссылаться на объекты ниже по файлу.
+# При SHARD_WORKERS > 0 отправки и очередь — в процессах-доставщиках, здесь их не видно.
+metrics.gauge("bot_users_in_chat", "Пользователей в чате.", lambda: len(users_in_chat))
+metrics.gauge("bot_private_inboxes", "Ящиков ЛС в памяти.", lambda: len(private_messages))
+metrics.gauge("bot_private_messages", "Сообщений во всех ящиках ЛС.",
+              lambda: sum(len(inbox) for inbox in list(private_messages.values())))
+metrics.gauge("bot_polls", "Открытых опросов.", lambda: len(polls))
+metrics.gauge("bot_outbox_queue_depth", "Заданий в очереди отправки (включая отложенные).",
+              lambda: outbox.depth())
+metrics.gauge("bot_digest_users", "Пользователей с неотправленным дайджестом.",
+              lambda: len(digests.buffers))
+
+# Этапы старта, секунды от запуска процесса: ready — инициализация закончена
+# (post_init), first_update — обработан первый апдейт. 0 — этап ещё не наступил.
+startup_times = {}
+
+def mark_startup(stage: str):
+    if stage not in startup_times:
+        startup_times[stage] = time.monotonic() - BOOT_STARTED
+        logging.info(f"Старт: {stage} через {startup_times[stage]:.3f} с")
+
+metrics.gauge("bot_startup_ready_seconds", "От запуска процесса до конца инициализации.",
+              lambda: startup_times.get("ready", 0))
+metrics.gauge("bot_startup_first_update_seconds", "От запуска процесса до первого обработанного апдейта.",
+              lambda: startup_times.get("first_update", 0))
+
+
+def instrument(callback):
+    """Обернуть хендлер: гистограмма длительности и счётчик исключений по имени функции."""
+    name = callback.__name__
+    latency = metrics.histogram("bot_handler_seconds", "Время обработки апдейта хендлером.", handler=name)
+    errors = metrics.counter("bot_handler_errors_total", "Исключений в хендлере.", handler=name)
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            latency.observe(time.perf_counter() - started)
+            if "first_update" not in startup_times:
+                mark_startup("first_update")
+
+    return timed
+
+def instrument_handlers(handlers):
+    """Обернуть все хендлеры, включая вложенные в ConversationHandler."""
+    for handler in handlers:
+        if isinstance(handler, ConversationHandler):
+            instrument_handlers(handler.entry_points)
+            for state_handlers in handler.states.values():
+                instrument_handlers(state_handlers)
+            instrument_handlers(handler.fallbacks)
+        else:
+            handler.callback = instrument(handler.callback)
 
 
 # ------------------------------------------------------------------------
 # 4) ГЛОБАЛЬНЫЕ СТРУКТУРЫ ДАННЫХ
 # ------------------------------------------------------------------------
-users_in_chat = {}       # { user_id: {...} }
+# Комнаты: ROOMS="main:Общий чат,ed:Анорексия,bul:Булимия" — ключ:название, первая — по умолчанию.
+# Ключ попадает в callback_data, поэтому короткий и без «|».
+ROOMS = {}
+for _part in os.getenv("ROOMS", "main:Общий чат").split(","):
+    _key, _, _title = _part.strip().partition(":")
+    if _key:
+        ROOMS[_key] = _title.strip() or _key
+if not ROOMS or any("|" in key for key in ROOMS):
+    raise ValueError("ROOMS must be a comma-separated list of key:title without '|' in keys!")
+DEFAULT_ROOM = next(iter(ROOMS))
+
+users_in_chat = {}       # { user_id: {..., "room": ключ комнаты} }
+room_members = {room: {} for room in ROOMS}   # { room: { user_id: None } } — в порядке входа
 users_history = {}       # { user_id: {...} }
-parted_users = []        # [(nick, code, time), ...]
-private_messages = {}    # { user_id: [ { from, text }, ... ] }
+parted_users = {room: [] for room in ROOMS}   # { room: [(nick, code, time), ...] }
+private_messages = {}    # { user_id: Inbox }
+bot_meta = {}            # { "commands_hash": ... } — служебное, переживает рестарт
 user_notify_settings = {}# { user_id: {...} }
-polls = {}               # { creator_id: {...} }
-admin_ids = set()
-moderator_ids = set()
+polls = {}               # { poll_id: Poll } — открытые опросы, см. 13) /poll
+admin_ids = {int(x) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()}
+moderator_ids = {int(x) for x in os.getenv("MODERATOR_IDS", "").split(",") if x.strip()}
 
 
 # ------------------------------------------------------------------------
@@ -81,20 +410,24 @@ def generate_nickname():
     return f"👤{''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz', k=6))}"
 
 def generate_personal_code():
-    """Случайный код вида #XXXX."""
-    return f"#{''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ', k=4))}"
+    """Случайный код вида #XXXX, не выданный никому раньше."""
+    while True:
+        code = f"#{''.join(random.choices('ABCDEFGHIJKLMNOPQRSTUVWXYZ', k=4))}"
+        if user_registry.reserve_code(code):
+            return code
 
 def ensure_user_in_dicts(user_id: int):
     """Добавляем запись для лички и уведомлений, если нет."""
     if user_id not in private_messages:
-        private_messages[user_id] = []
+        private_messages[user_id] = Inbox()  # пустой ящик не пишем — пишем при первом сообщении
     if user_id not in user_notify_settings:
         user_notify_settings[user_id] = {
             "privates": False,
             "replies": False,
             "hug": False,
-            "interval": 5,
+            "interval": 0,
         }
+        state_store.mark("user_notify_settings", user_id)
 
 def get_user_role(user_id: int) -> str:
     """Роль: admin | moderator | new | resident"""
@@ -129,43 +462,1172 @@ def get_moon_symbol(seconds_diff: float) -> str:
 
 def get_user_by_code(code: str):
     """Найти user_id по коду."""
-    for u_id, data in users_in_chat.items():
-        if data["code"].lower() == code.lower():
-            return u_id
-    return None
+    return user_registry.by_code(code)
 
 def update_last_activity(user_id: int):
     """Обновить время последней активности."""
     if user_id in users_in_chat:
         users_in_chat[user_id]["last_activity"] = datetime.datetime.now()
+        state_store.mark("users_in_chat", user_id)
+        idle_tracker.touch(user_id)
+        if user_id in digests.buffers:
+            digests.flush_user(user_id)
+
+def roster_changed(user_id: int = None):
+    """Вход/выход/смена ника или комнаты: сбросить снимки /list и пикеры получателей."""
+    user_list_cache.invalidate(user_id)
+    msg_picker.invalidate(user_id)
+    hug_picker.invalidate(user_id)
+
+def room_of(user_id: int) -> str:
+    return users_in_chat[user_id].get("room", DEFAULT_ROOM)
+
+def room_ns(base: str, room: str) -> str:
+    """Пространство имён хранилища для комнаты; у комнаты по умолчанию — прежнее имя."""
+    return base if room == DEFAULT_ROOM else f"{base}:{room}"
+
+def move_to_room(user_id: int, room: str):
+    """Перевести пользователя в комнату: O(1) на индекс членства."""
+    info = users_in_chat[user_id]
+    room_members[info.get("room", DEFAULT_ROOM)].pop(user_id, None)
+    room_members[room][user_id] = None
+    info["room"] = room
+    users_history[user_id]["room"] = room
+    roster_changed()
+    state_store.mark("users_in_chat", user_id)
+    state_store.mark("users_history", user_id)
+
+def remove_from_chat(user_id: int):
+    """Убрать пользователя из активного списка и всех индексов. Вернёт его запись или None."""
+    info = users_in_chat.pop(user_id, None)
+    if info is None:
+        return None
+    room = info.get("room", DEFAULT_ROOM)
+    room_members[room].pop(user_id, None)
+    user_registry.remove(user_id, info["code"])
+    roster_changed(user_id)
+    digests.drop(user_id)
+    idle_tracker.forget(user_id)
+    flood_guard.forget(user_id)
+    trigger_filter.noticed.pop(user_id, None)
+
+    users_history[user_id]["left_at"] = time.time()   # для «пока тебя не было»
+    state_store.mark("users_history", user_id)
+    parted = parted_users[room]
+    parted.insert(0, (info["nickname"], info["code"], datetime.datetime.now()))
+    if len(parted) > 20:
+        parted.pop()
+    state_store.mark("users_in_chat", user_id)
+    state_store.mark(room_ns("parted_users", room))
+    return info
 
 
-# Широковещательная рассылка текста
-async def broadcast_text(telegram_app, text: str, exclude_user: int = None):
-    """Рассылка текста всем, кроме exclude_user."""
-    for uid, info in users_in_chat.items():
-        if uid == exclude_user:
-            continue
+# ------------------------------------------------------------------------
+# 5.1) РЕЕСТР ПОЛЬЗОВАТЕЛЕЙ: ИНДЕКСЫ ПО КОДУ И НИКУ
+# ------------------------------------------------------------------------
+class UserRegistry:
+    """
+    Индексы поверх users_in_chat:
+    - код -> user_id для активных (O(1) в /msg CODE и /hug CODE);
+    - триграммы ника -> user_id для /search;
+    - все когда-либо выданные коды, чтобы не раздать один код дважды.
+    """
+
+    def __init__(self):
+        self.issued_codes = set()  # { "#ABCD", ... }
+        self.code_to_user = {}     # { "#abcd": user_id }
+        self.nicks = {}            # { user_id: ник в нижнем регистре }
+        self.trigrams = {}         # { "abc": {user_id, ...} }
+
+    @staticmethod
+    def _grams(text: str) -> set:
+        return {text[i:i + 3] for i in range(len(text) - 2)}
+
+    def reserve_code(self, code: str) -> bool:
+        """Занять код. False, если он уже выдан."""
+        code = code.upper()
+        if code in self.issued_codes:
+            return False
+        self.issued_codes.add(code)
+        return True
+
+    def add(self, user_id: int, nickname: str, code: str):
+        self.issued_codes.add(code.upper())
+        self.code_to_user[code.lower()] = user_id
+        self._index_nick(user_id, nickname)
+
+    def remove(self, user_id: int, code: str):
+        if self.code_to_user.get(code.lower()) == user_id:
+            del self.code_to_user[code.lower()]
+        self._unindex_nick(user_id)
+
+    def rename(self, user_id: int, nickname: str):
+        self._unindex_nick(user_id)
+        self._index_nick(user_id, nickname)
+
+    def by_code(self, code: str):
+        return self.code_to_user.get(code.lower())
+
+    def search(self, pattern: str) -> list:
+        """user_id активных, у кого pattern входит в ник (без учёта регистра)."""
+        pattern = pattern.lower()
+        if len(pattern) < 3:
+            return [uid for uid, nick in self.nicks.items() if pattern in nick]
+        postings = sorted((self.trigrams.get(g, ()) for g in self._grams(pattern)), key=len)
+        if not postings[0]:
+            return []
+        candidates = set(postings[0]).intersection(*postings[1:])
+        return [uid for uid in candidates if pattern in self.nicks[uid]]
+
+    def _index_nick(self, user_id: int, nickname: str):
+        nick = nickname.lower()
+        self.nicks[user_id] = nick
+        for g in self._grams(nick):
+            self.trigrams.setdefault(g, set()).add(user_id)
+
+    def _unindex_nick(self, user_id: int):
+        nick = self.nicks.pop(user_id, None)
+        if nick is None:
+            return
+        for g in self._grams(nick):
+            bucket = self.trigrams.get(g)
+            if bucket is not None:
+                bucket.discard(user_id)
+                if not bucket:
+                    del self.trigrams[g]
+
+
+user_registry = UserRegistry()
+
+
+# ------------------------------------------------------------------------
+# 5.2) ДОСТАВКА: ОЧЕРЕДЬ ОТПРАВКИ С ЛИМИТАМИ TELEGRAM
+# ------------------------------------------------------------------------
+SEND_WORKERS = int(os.getenv("SEND_WORKERS", "16"))
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))  # сообщений/сек на бота
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))       # сообщений/сек в один чат
+SEND_MAX_ATTEMPTS = int(os.getenv("SEND_MAX_ATTEMPTS", "6"))   # попыток при сетевых ошибках
+SEND_BACKOFF_MAX = 300.0                                        # потолок паузы между попытками
+DEAD_LETTER_AFTER = int(os.getenv("DEAD_LETTER_AFTER", "3"))   # Forbidden подряд до исключения
+OUTBOX_DB = os.getenv("OUTBOX_DB", "outbox.db")                 # ":memory:" — без журнала
+SHARD_WORKERS = int(os.getenv("SHARD_WORKERS", "0"))           # >0 — доставка в N процессах
+SHARD_POLL_INTERVAL = 0.05                                      # сек между опросами общего журнала
+SHUTDOWN_TIMEOUT = float(os.getenv("SHUTDOWN_TIMEOUT", "8"))   # сек на досылку очереди при остановке
+
+# Полосы приоритета: меньше — раньше, внутри полосы — в порядке постановки.
+PRIORITY_DIRECT = 0   # ЛС, ответы, обнимашки, ответы на команды
+PRIORITY_CHAT = 1     # сообщения общего чата
+PRIORITY_BULK = 2     # правки опросов, входы/выходы, дайджесты
+SEND_LANES = ("direct", "chat", "bulk")
+
+SEND_RESULTS = {
+    result: metrics.counter("bot_send_total", "Результаты отправок.", result=result)
+    for result in ("sent", "retry_after", "forbidden", "network_retry", "failed")
+}
+BROADCAST_FANOUT = metrics.histogram("bot_broadcast_fanout", "Получателей в одной рассылке.",
+                                     FANOUT_BUCKETS)
+BROADCAST_ENQUEUE = metrics.histogram("bot_broadcast_enqueue_seconds",
+                                      "Время постановки рассылки в очередь.")
+BROADCAST_DELIVERY = metrics.histogram("bot_broadcast_delivery_seconds",
+                                       "От начала рассылки до последней отправки.")
+SEND_WAIT = [
+    metrics.histogram("bot_send_wait_seconds", "От постановки в очередь до отправки.", lane=lane)
+    for lane in SEND_LANES
+]
+
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, не больше capacity подряд."""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """Взять токен. Вернёт 0, если взяли, иначе сколько секунд ждать."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    async def acquire(self):
+        while True:
+            wait = self.take()
+            if not wait:
+                return
+            await asyncio.sleep(wait)
+
+
+class BroadcastBatch:
+    """Задания одной рассылки: когда завершится последнее, пишем длительность рассылки."""
+    __slots__ = ("started", "pending")
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.pending = 0
+
+    def done(self):
+        self.pending -= 1
+        if self.pending == 0:
+            BROADCAST_DELIVERY.observe(time.perf_counter() - self.started)
+
+
+class OutboundJob:
+    """Одна отправка: метод бота + аргументы + чат получателя."""
+    __slots__ = ("id", "chat_id", "method", "kwargs", "label", "attempts", "on_sent", "on_failed",
+                 "want_result", "batch", "priority", "seq", "queued")
+
+    def __init__(self, chat_id: int, method: str, kwargs: dict, label: str = "",
+                 attempts: int = 0, on_sent=None, job_id: int = None, want_result: bool = False,
+                 priority: int = PRIORITY_DIRECT, on_failed=None):
+        self.id = job_id
+        self.chat_id = chat_id
+        self.method = method
+        self.kwargs = kwargs
+        self.label = label
+        self.attempts = attempts
+        self.on_sent = on_sent
+        self.on_failed = on_failed
+        self.want_result = want_result or on_sent is not None or on_failed is not None
+        self.batch = None
+        self.priority = priority
+        self.seq = None       # порядок внутри полосы; при повторе не меняется
+        self.queued = time.monotonic()
+
+
+class SentMessage:
+    """То, что фронт узнаёт об отправке из процесса-доставщика."""
+    __slots__ = ("message_id", "chat_id")
+
+    def __init__(self, message_id: int, chat_id: int):
+        self.message_id = message_id
+        self.chat_id = chat_id
+
+
+def shard_of(chat_id: int, shards: int) -> int:
+    return abs(chat_id) % shards
+
+
+class OutboxJournal:
+    """
+    SQLite-журнал неотправленных заданий и «мёртвых» чатов.
+    Записи копятся в открытой транзакции и коммитятся одним разом
+    на следующей итерации event loop — рассылка на 500 человек = 1 коммит.
+
+    В многопроцессном режиме это же общее хранилище между фронтом и
+    доставщиками: фронт пишет задания, доставщик своей доли чатов
+    забирает новые строки, а в results кладёт message_id и dead letters.
+    """
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS outbox ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " chat_id INTEGER NOT NULL, method TEXT NOT NULL, kwargs TEXT NOT NULL,"
+            " label TEXT, attempts INTEGER NOT NULL DEFAULT 0,"
+            " want_result INTEGER NOT NULL DEFAULT 0,"
+            f" priority INTEGER NOT NULL DEFAULT {PRIORITY_CHAT})"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS dead_letters ("
+            " chat_id INTEGER PRIMARY KEY, error TEXT, at REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS results ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " job_id INTEGER, chat_id INTEGER NOT NULL, status TEXT NOT NULL, message_id INTEGER)"
+        )
+        self.db.commit()
+        self.commit_scheduled = False
+
+    def _touch(self):
+        if not self.commit_scheduled:
+            self.commit_scheduled = True
+            asyncio.get_running_loop().call_soon(self.commit)
+
+    def commit(self):
+        self.commit_scheduled = False
+        self.db.commit()
+
+    def add(self, job: OutboundJob) -> int:
+        cur = self.db.execute(
+            "INSERT INTO outbox (chat_id, method, kwargs, label, attempts, want_result, priority)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job.chat_id, job.method, json.dumps(job.kwargs, ensure_ascii=False), job.label,
+             job.attempts, int(job.want_result), job.priority)
+        )
+        self._touch()
+        return cur.lastrowid
+
+    def set_attempts(self, job: OutboundJob):
+        self.db.execute("UPDATE outbox SET attempts = ? WHERE id = ?", (job.attempts, job.id))
+        self._touch()
+
+    def remove(self, job: OutboundJob):
+        self.db.execute("DELETE FROM outbox WHERE id = ?", (job.id,))
+        self._touch()
+
+    def pending(self, shard: tuple = None, after_id: int = 0):
+        """Задания с id > after_id; shard=(k, n) — только чаты, где abs(chat_id) % n == k."""
+        query = ("SELECT id, chat_id, method, kwargs, label, attempts, want_result, priority"
+                 " FROM outbox WHERE id > ?")
+        params = [after_id]
+        if shard:
+            query += " AND abs(chat_id) % ? = ?"
+            params += [shard[1], shard[0]]
+        for job_id, chat_id, method, kwargs, label, attempts, want_result, priority in \
+                self.db.execute(query + " ORDER BY id", params).fetchall():
+            yield OutboundJob(chat_id, method, json.loads(kwargs), label, attempts,
+                              job_id=job_id, want_result=bool(want_result), priority=priority)
+
+    def add_result(self, job: OutboundJob, status: str, message_id: int = None):
+        self.db.execute(
+            "INSERT INTO results (job_id, chat_id, status, message_id) VALUES (?, ?, ?, ?)",
+            (job.id, job.chat_id, status, message_id)
+        )
+        self._touch()
+
+    def take_results(self) -> list:
+        rows = self.db.execute("SELECT id, job_id, chat_id, status, message_id FROM results ORDER BY id").fetchall()
+        if rows:
+            self.db.execute("DELETE FROM results WHERE id <= ?", (rows[-1][0],))
+            self._touch()
+        return rows
+
+    def add_dead(self, chat_id: int, error: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO dead_letters (chat_id, error, at) VALUES (?, ?, ?)",
+            (chat_id, error, time.time())
+        )
+        self._touch()
+
+    def remove_dead(self, chat_id: int):
+        self.db.execute("DELETE FROM dead_letters WHERE chat_id = ?", (chat_id,))
+        self._touch()
+
+    def dead_chats(self) -> set:
+        return {row[0] for row in self.db.execute("SELECT chat_id FROM dead_letters")}
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+
+class Outbox:
+    """
+    Очередь исходящих сообщений.
+    Хендлеры только ставят задания (enqueue) и сразу возвращаются,
+    а отправляют SEND_WORKERS воркеров с общим лимитом на бота
+    и отдельным лимитом на каждый чат.
+
+    Задания пишутся в журнал и переживают рестарт. RetryAfter ставит
+    на паузу всех воркеров, сетевые ошибки — повтор с экспоненциальной
+    паузой, Forbidden подряд DEAD_LETTER_AFTER раз — чат в dead letters
+    и вызов on_dead_letter(chat_id).
+
+    Режимы start(): обычный — всё в этом процессе; producer=True — только
+    пишем в журнал, отправляют процессы-доставщики; shard=(k, n) — это
+    доставщик k-й доли чатов, новые задания он подбирает из журнала.
+
+    Очередь приоритетная: (полоса, номер постановки). ЛС и ответы не ждут
+    рассылку на всю комнату, а правки опросов и «вошёл/вышел» уступают всем.
+    """
+
+    def __init__(self, workers: int, global_rate: float, chat_rate: float):
+        self.workers = workers
+        self.chat_interval = 1.0 / chat_rate
+        # Без запаса: после простоя полный бакет дал бы ещё rate отправок сверх лимита
+        # в первую же секунду — ровно global_rate в любом окне 1 с
+        self.global_bucket = TokenBucket(global_rate, 1)
+        self.chat_next = {}   # { chat_id: время, раньше которого в чат не шлём }
+        self.queue = asyncio.PriorityQueue()   # (приоритет, seq, задание)
+        self.seq = itertools.count()
+        self.tasks = []
+        self.bot = None
+        self.journal = None
+        self.paused_until = 0.0
+        self.forbidden_count = {}  # { chat_id: сколько Forbidden подряд }
+        self.dead_chats = set()
+        self.on_dead_letter = None
+        self.producer = False
+        self.shard = None
+        self.callbacks = {}   # { job_id: (on_sent, on_failed) } — в режиме producer
+        self.deferred = 0     # заданий, отложенных через call_later
+        self.busy = 0         # заданий на руках у воркеров (ждут токен или ответ API)
+
+    def enqueue(self, chat_id: int, method: str, label: str = "", on_sent=None,
+                batch: BroadcastBatch = None, priority: int = PRIORITY_DIRECT, on_failed=None, **kwargs):
+        """
+        Поставить отправку в очередь. Не ждёт самой отправки.
+        on_sent(message) вызывается после успешной отправки (не переживает рестарт);
+        у message гарантированы только message_id и chat_id.
+        on_failed() — если задание снято без отправки (ошибка, Forbidden, dead letter).
+        batch — рассылка, к которой относится задание (для метрик).
+        priority — полоса PRIORITY_*; по умолчанию личное, рассылки передают свою.
+        """
+        if chat_id in self.dead_chats:
+            if on_failed:
+                self._callback(on_failed, label)
+            return
+        markup = kwargs.get("reply_markup")
+        if markup is not None and not isinstance(markup, dict):
+            kwargs["reply_markup"] = markup.to_dict()
+        job = OutboundJob(chat_id, method, kwargs, label, on_sent=on_sent, priority=priority,
+                          on_failed=on_failed)
+        if self.journal:
+            job.id = self.journal.add(job)
+        if batch is not None:
+            batch.pending += 1   # и при producer: это bot_broadcast_fanout
+        if self.producer:
+            # Отправки — в другом процессе: длительность рассылки здесь не узнать
+            if on_sent or on_failed:
+                self.callbacks[job.id] = (on_sent, on_failed)
+            return
+        job.batch = batch
+        self._put(job)
+
+    def _put(self, job: OutboundJob):
+        if job.seq is None:
+            job.seq = next(self.seq)
+        self.queue.put_nowait((job.priority, job.seq, job))
+
+    def depth(self) -> int:
+        return self.queue.qsize() + self.deferred
+
+    def revive(self, chat_id: int):
+        """Чат снова доступен (пользователь вернулся через /start)."""
+        self.forbidden_count.pop(chat_id, None)
+        if chat_id in self.dead_chats:
+            self.dead_chats.discard(chat_id)
+            if self.journal:
+                self.journal.remove_dead(chat_id)
+
+    def start(self, bot, journal_path: str = OUTBOX_DB, producer: bool = False, shard: tuple = None):
+        self.bot = bot
+        self.producer = producer
+        self.shard = shard
+        self.queue = asyncio.PriorityQueue()
+        self.deferred = 0
+        self.journal = OutboxJournal(journal_path)
+        self.dead_chats = self.journal.dead_chats()
+        if producer:
+            self.tasks = [asyncio.create_task(self._poll_results())]
+            return
+        self.last_seen = 0
+        restored = 0
+        for job in self.journal.pending(shard):
+            self._put(job)
+            self.last_seen = job.id
+            restored += 1
+        if restored:
+            logging.info(f"Из журнала восстановлено {restored} неотправленных сообщений.")
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        if shard:
+            self.tasks.append(asyncio.create_task(self._poll_jobs()))
+
+    async def drain(self, timeout: float) -> int:
+        """
+        Дождаться, пока очередь (и отложенные повторы) отправится, но не дольше timeout.
+        Вернёт, сколько заданий осталось; с журналом они уйдут после рестарта.
+        """
+        if self.producer or not self.tasks:
+            return 0   # отправляют доставщики, задания уже в общем журнале
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                await asyncio.wait_for(self.queue.join(), max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                break
+            if not self.deferred or time.monotonic() >= deadline:
+                break
+            await asyncio.sleep(min(0.1, deadline - time.monotonic()))
+        return self.depth() + self.busy
+
+    async def stop(self):
+        for t in self.tasks:
+            t.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+        if self.journal:
+            self.journal.close()
+            self.journal = None
+
+    async def _poll_jobs(self):
+        """Доставщик: подбираем из журнала новые задания своей доли и обновляем dead letters."""
+        ticks = 0
+        while True:
+            await asyncio.sleep(SHARD_POLL_INTERVAL)
+            for job in self.journal.pending(self.shard, self.last_seen):
+                self._put(job)
+                self.last_seen = job.id
+            ticks += 1
+            if ticks % 20 == 0:
+                self.dead_chats = self.journal.dead_chats()
+
+    async def _poll_results(self):
+        """Фронт: message_id отправленного и dead letters от доставщиков."""
+        while True:
+            await asyncio.sleep(SHARD_POLL_INTERVAL)
+            for _, job_id, chat_id, status, message_id in self.journal.take_results():
+                if status == "dead":
+                    # Следом придёт и итог самого задания («failed»)
+                    if chat_id not in self.dead_chats:
+                        self.dead_chats.add(chat_id)
+                        if self.on_dead_letter:
+                            self.on_dead_letter(chat_id)
+                    continue
+                on_sent, on_failed = self.callbacks.pop(job_id, (None, None))
+                if status == "sent" and on_sent:
+                    self._callback(on_sent, str(chat_id), SentMessage(message_id, chat_id))
+                elif status != "sent" and on_failed:
+                    self._callback(on_failed, str(chat_id))
+
+    def _chat_delay(self, chat_id: int) -> float:
+        """Сколько ждать до следующей отправки в чат (0 — можно сейчас, слот занят)."""
+        now = time.monotonic()
+        ready_at = self.chat_next.get(chat_id, 0.0)
+        if ready_at > now:
+            return ready_at - now
+        self.chat_next[chat_id] = now + self.chat_interval
+        if len(self.chat_next) > 10000:
+            self.chat_next = {c: t for c, t in self.chat_next.items() if t > now}
+        return 0.0
+
+    def _retry_later(self, job: OutboundJob, delay: float):
+        self.deferred += 1
+        asyncio.get_running_loop().call_later(delay, self._requeue, job)
+
+    def _requeue(self, job: OutboundJob):
+        self.deferred -= 1
+        self._put(job)
+
+    def _finish(self, job: OutboundJob, status: str = "failed", message_id: int = None):
+        if job.batch is not None:
+            job.batch.done()
+        if status != "sent" and job.on_failed:
+            self._callback(job.on_failed, job.label)
+        if not self.journal or job.id is None:
+            return
+        self.journal.remove(job)
+        if self.shard and job.want_result:
+            self.journal.add_result(job, status, message_id)
+
+    @staticmethod
+    def _callback(fn, label: str, *args):
         try:
-            await telegram_app.bot.send_message(chat_id=info["chat_id"], text=text)
+            fn(*args)
         except Exception as e:
-            logging.warning(f"Ошибка отправки текста {info['nickname']}: {e}")
+            logging.warning(f"Ошибка обработчика отправки {label}: {e}")
+
+    def _forbidden(self, job: OutboundJob, error: Exception):
+        count = self.forbidden_count.get(job.chat_id, 0) + 1
+        self.forbidden_count[job.chat_id] = count
+        send_errors.add("Forbidden при отправке", error, job.label)
+        if count < DEAD_LETTER_AFTER or job.chat_id in self.dead_chats:
+            return
+        self.dead_chats.add(job.chat_id)
+        if self.journal:
+            self.journal.add_dead(job.chat_id, str(error))
+            if self.shard:
+                self.journal.add_result(job, "dead")
+        send_errors.add("Чат перенесён в dead letters", "", f"{job.chat_id} {job.label}")
+        if self.on_dead_letter:
+            self.on_dead_letter(job.chat_id)
+
+    async def _send(self, job: OutboundJob):
+        kwargs = job.kwargs
+        markup = kwargs.get("reply_markup")
+        if isinstance(markup, dict):
+            kwargs = dict(kwargs, reply_markup=InlineKeyboardMarkup.de_json(markup, self.bot))
+        if job.method == "send_media_group":
+            # В журнале альбом хранится словарями — собираем InputMedia* обратно
+            kwargs = dict(kwargs, media=[
+                ALBUM_INPUTS[m["type"]](m["media"], caption=m.get("caption")) for m in kwargs["media"]
+            ])
+        return await getattr(self.bot, job.method)(chat_id=job.chat_id, **kwargs)
+
+    async def _worker(self):
+        while True:
+            _, _, job = await self.queue.get()
+            self.busy += 1
+            try:
+                if job.chat_id in self.dead_chats:
+                    self._finish(job)
+                    continue
+                wait = self.paused_until - time.monotonic()
+                if wait <= 0:
+                    wait = self._chat_delay(job.chat_id)
+                if wait > 0:
+                    # Чат ещё «остывает» или флуд-контроль — вернём задание позже, не занимая воркер
+                    self._retry_later(job, wait)
+                    continue
+                # Токен — только с заданием на руках: простаивающий воркер не должен
+                # копить токен сверх ёмкости бакета (иначе всплеск превысит лимит).
+                # Обгонять ЛС могут лишь SEND_WORKERS уже взятых заданий.
+                await self.global_bucket.acquire()
+                result = await self._send(job)
+            except asyncio.CancelledError:
+                raise
+            except RetryAfter as e:
+                SEND_RESULTS["retry_after"].inc()
+                self.paused_until = max(self.paused_until, time.monotonic() + e.retry_after)
+                send_errors.add("RetryAfter, пауза рассылки", f"{e.retry_after}с")
+                self._retry_later(job, e.retry_after)
+            except Forbidden as e:
+                SEND_RESULTS["forbidden"].inc()
+                self._forbidden(job, e)
+                self._finish(job)
+            except (TimedOut, NetworkError) as e:
+                if isinstance(e, BadRequest) or job.attempts + 1 >= SEND_MAX_ATTEMPTS:
+                    send_errors.add(f"Ошибка отправки ({job.method})", e, job.label)
+                    SEND_RESULTS["failed"].inc()
+                    self._finish(job)
+                else:
+                    SEND_RESULTS["network_retry"].inc()
+                    job.attempts += 1
+                    if self.journal and job.id is not None:
+                        self.journal.set_attempts(job)
+                    delay = min(SEND_BACKOFF_MAX, 2 ** job.attempts) * random.uniform(0.5, 1.0)
+                    self._retry_later(job, delay)
+            except RuntimeError as e:
+                # Локальная причина (клиент бота закрыт на остановке): сообщение не
+                # отвергнуто Telegram — строку журнала не трогаем, уйдёт после рестарта
+                send_errors.add(f"Отправка прервана ({job.method})", e, job.label)
+                if job.batch is not None:
+                    job.batch.done()
+            except Exception as e:
+                send_errors.add(f"Ошибка отправки ({job.method})", e, job.label)
+                SEND_RESULTS["failed"].inc()
+                self._finish(job)
+            else:
+                SEND_RESULTS["sent"].inc()
+                SEND_WAIT[job.priority].observe(time.monotonic() - job.queued)
+                self.forbidden_count.pop(job.chat_id, None)
+                self._finish(job, "sent", getattr(result, "message_id", None))
+                if job.on_sent:
+                    self._callback(job.on_sent, job.label, result)
+            finally:
+                self.busy -= 1
+                self.queue.task_done()
+
+
+outbox = Outbox(SEND_WORKERS, SEND_GLOBAL_RATE, SEND_CHAT_RATE)
+
+
+def evict_dead_chat(chat_id: int):
+    """Убрать из активного списка пользователя, который заблокировал бота."""
+    for uid, info in list(users_in_chat.items()):
+        if info["chat_id"] != chat_id:
+            continue
+        remove_from_chat(uid)
+        send_errors.add("Исключён из чата: бот заблокирован", "", f"{uid} {info['nickname']}")
+
+outbox.on_dead_letter = evict_dead_chat
+
+
+# ------------------------------------------------------------------------
+# 5.3) ХРАНИЛИЩЕ СОСТОЯНИЯ (write-behind)
+# ------------------------------------------------------------------------
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")   # sqlite | memory
+STATE_DB = os.getenv("STATE_DB", "state.db")
+STATE_FLUSH_INTERVAL = float(os.getenv("STATE_FLUSH_INTERVAL", "1.0"))
+
+
+def _to_json(obj):
+    """Приводим состояние к JSON без потерь: datetime, set, tuple, dict с int-ключами."""
+    if isinstance(obj, dict):
+        if all(isinstance(k, str) for k in obj):
+            return {k: _to_json(v) for k, v in obj.items()}
+        return {"__items__": [[k, _to_json(v)] for k, v in obj.items()]}
+    if isinstance(obj, list):
+        return [_to_json(v) for v in obj]
+    if isinstance(obj, tuple):
+        return {"__tuple__": [_to_json(v) for v in obj]}
+    if isinstance(obj, (set, frozenset)):
+        return {"__set__": [_to_json(v) for v in obj]}
+    if isinstance(obj, datetime.datetime):
+        return {"__dt__": obj.isoformat()}
+    return obj
+
+def _from_json_hook(d: dict):
+    if len(d) == 1:
+        if "__dt__" in d:
+            return datetime.datetime.fromisoformat(d["__dt__"])
+        if "__set__" in d:
+            return set(d["__set__"])
+        if "__tuple__" in d:
+            return tuple(d["__tuple__"])
+        if "__items__" in d:
+            return {k: v for k, v in d["__items__"]}
+    return d
+
+def dump_state_value(value) -> str:
+    return json.dumps(_to_json(value), ensure_ascii=False, separators=(",", ":"))
+
+def load_state_values(payloads: list) -> list:
+    """Разобрать пачку записей одним вызовом json.loads — так в разы быстрее, чем по одной."""
+    blob = "[" + ",".join(payloads) + "]"
+    # Быстрый путь: в простых записях нет служебных ключей
+    if '"__' not in blob:
+        return json.loads(blob)
+    return json.loads(blob, object_hook=_from_json_hook)
+
+
+class MemoryStateBackend:
+    """Ничего не пишет на диск: состояние живёт до рестарта."""
+
+    def load(self, namespace: str) -> dict:
+        return {}
+
+    def write(self, rows: list):
+        pass
+
+    def close(self):
+        pass
+
+
+class SqliteStateBackend:
+    """Таблица kv(ns, key, value) в SQLite с WAL. write() зовётся из потока-писателя."""
+
+    def __init__(self, path: str):
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS kv ("
+            " ns TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,"
+            " PRIMARY KEY (ns, key)) WITHOUT ROWID"
+        )
+        self.db.commit()
+
+    def load(self, namespace: str) -> dict:
+        with self.lock:
+            rows = self.db.execute("SELECT key, value FROM kv WHERE ns = ?", (namespace,)).fetchall()
+        return dict(rows)
+
+    def write(self, rows: list):
+        """rows: [(ns, key, value | None)], None — удалить."""
+        upserts = [r for r in rows if r[2] is not None]
+        deletes = [(ns, key) for ns, key, value in rows if value is None]
+        with self.lock:
+            with self.db:
+                if upserts:
+                    self.db.executemany("INSERT OR REPLACE INTO kv (ns, key, value) VALUES (?, ?, ?)", upserts)
+                if deletes:
+                    self.db.executemany("DELETE FROM kv WHERE ns = ? AND key = ?", deletes)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class StateStore:
+    """
+    Write-behind поверх глобальных словарей.
+    Хендлеры только помечают ключ грязным (mark) — это O(1) без диска.
+    Раз в STATE_FLUSH_INTERVAL грязные записи сериализуются в event loop
+    и одной транзакцией пишутся в бэкенд в отдельном потоке.
+    """
+
+    LIST_KEY = "*"
+
+    def __init__(self):
+        self.backend = MemoryStateBackend()
+        self.tables = {}   # { ns: (dict | list, тип ключа, encode, decode) }
+        self.dirty = set() # { (ns, key) }
+        self.flush_task = None
+
+    def register(self, namespace: str, container, key_type=int, encode=None, decode=None):
+        """
+        Подключить словарь (или список — хранится целиком) к хранилищу.
+        encode/decode — для значений-объектов: объект <-> JSON-совместимое значение.
+        """
+        self.tables[namespace] = (container, key_type, encode, decode)
+
+    def mark(self, namespace: str, key=LIST_KEY):
+        self.dirty.add((namespace, key))
+
+    def open(self, backend):
+        """Подключить бэкенд и восстановить из него все зарегистрированные таблицы."""
+        self.backend = backend
+        for namespace, (container, key_type, _, decode) in self.tables.items():
+            rows = backend.load(namespace)
+            if isinstance(container, list):
+                if self.LIST_KEY in rows:
+                    container[:] = load_state_values([rows[self.LIST_KEY]])[0]
+                continue
+            values = load_state_values(list(rows.values()))
+            if decode:
+                values = map(decode, values)
+            container.update(zip(map(key_type, rows), values))
+
+    def _collect(self) -> list:
+        rows = []
+        dirty, self.dirty = self.dirty, set()
+        for namespace, key in dirty:
+            container, _, encode, _ = self.tables[namespace]
+            if isinstance(container, list):
+                rows.append((namespace, self.LIST_KEY, dump_state_value(container)))
+            elif key in container:
+                value = container[key]
+                rows.append((namespace, str(key), dump_state_value(encode(value) if encode else value)))
+            else:
+                rows.append((namespace, str(key), None))
+        return rows
+
+    async def flush(self):
+        if not self.dirty:
+            return
+        rows = self._collect()
+        await asyncio.get_running_loop().run_in_executor(None, self.backend.write, rows)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(STATE_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logging.warning(f"Ошибка записи состояния: {e}")
+
+    def start(self):
+        self.flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self.flush_task:
+            self.flush_task.cancel()
+            await asyncio.gather(self.flush_task, return_exceptions=True)
+            self.flush_task = None
+        await self.flush()
+        self.backend.close()
+
+
+state_store = StateStore()
+state_store.register("users_in_chat", users_in_chat)
+state_store.register("users_history", users_history)
+state_store.register("user_notify_settings", user_notify_settings)
+state_store.register("bot_meta", bot_meta, key_type=str)
+for _room in ROOMS:
+    state_store.register(room_ns("parted_users", _room), parted_users[_room])
+
+
+def restore_state():
+    """Поднять состояние из STATE_BACKEND и перестроить индексы."""
+    started = time.perf_counter()
+    if STATE_BACKEND == "sqlite":
+        state_store.open(SqliteStateBackend(STATE_DB))
+    else:
+        state_store.open(MemoryStateBackend())
+    for data in users_history.values():
+        user_registry.reserve_code(data["code"])
+    for uid, data in users_in_chat.items():
+        if data.get("room") not in ROOMS:
+            data["room"] = DEFAULT_ROOM   # комната удалена из ROOMS или запись до комнат
+        room_members[data["room"]][uid] = None
+        user_registry.add(uid, data["nickname"], data["code"])
+        idle_tracker.touch(uid, data["last_activity"].timestamp())
+    for poll in polls.values():
+        poll_engine.index(poll)
+    logging.info(
+        f"Состояние восстановлено за {time.perf_counter() - started:.3f}с: "
+        f"{len(users_history)} в истории, {len(users_in_chat)} в чате."
+    )
+
+
+# ------------------------------------------------------------------------
+# 5.4) ДАЙДЖЕСТЫ ПО НАСТРОЙКАМ /notify
+# ------------------------------------------------------------------------
+DIGEST_MAX_LINES = 300     # строк в буфере одного пользователя, дальше — только счётчик
+MESSAGE_LIMIT = 4000       # запас до 4096 символов Telegram
+NOTIFY_FLAGS = {"private": "privates", "reply": "replies", "hug": "hug"}
+
+
+class DigestScheduler:
+    """
+    Копит сообщения пользователям с ненулевым interval в /notify и раз в
+    interval минут отправляет их одним сообщением (или парой, если длинно).
+    Категории private/reply/hug с включённым флагом идут сразу, минуя дайджест.
+    «Припаркованные» (долго неактивные) получают дайджест не реже PARK_DIGEST_INTERVAL.
+    Как только пользователь сам что-то пишет — его буфер уходит сразу.
+    """
+
+    def __init__(self):
+        self.buffers = {}   # { uid: [строки] }
+        self.dropped = {}   # { uid: сколько строк не влезло }
+        self.due = []       # куча (время отправки, uid); записи без пары в deadline — устаревшие
+        self.deadline = {}  # { uid: время отправки текущего буфера }
+        self.task = None
+        self.wakeup = asyncio.Event()
+
+    def offer(self, user_id: int, kind: str, text: str) -> bool:
+        """True — сообщение ушло в дайджест, отправлять сейчас не нужно."""
+        settings = user_notify_settings.get(user_id) or {}
+        interval = settings.get("interval", 0)
+        if user_id in idle_tracker.parked:
+            interval = max(interval, PARK_DIGEST_INTERVAL)
+        if not interval:
+            return False
+        flag = NOTIFY_FLAGS.get(kind)
+        if flag and settings.get(flag):
+            return False
+        buf = self.buffers.get(user_id)
+        if buf is None:
+            buf = self.buffers[user_id] = []
+            due = self.deadline[user_id] = time.monotonic() + interval * 60
+            heapq.heappush(self.due, (due, user_id))
+            self.wakeup.set()
+        if len(buf) < DIGEST_MAX_LINES:
+            buf.append(text)
+        else:
+            self.dropped[user_id] = self.dropped.get(user_id, 0) + 1
+        return True
+
+    def drop(self, user_id: int):
+        self.buffers.pop(user_id, None)
+        self.dropped.pop(user_id, None)
+        self.deadline.pop(user_id, None)
+
+    def flush_user(self, user_id: int):
+        self.deadline.pop(user_id, None)
+        lines = self.buffers.pop(user_id, None)
+        dropped = self.dropped.pop(user_id, 0)
+        info = users_in_chat.get(user_id)
+        if not lines or info is None:
+            return
+        if dropped:
+            lines.append(f"…и ещё {dropped}")
+        header = f"[BOT] Пока тебя не было ({len(lines)}):"
+        for chunk in chunk_lines([header] + lines, MESSAGE_LIMIT):
+            outbox.enqueue(info["chat_id"], "send_message", label=info["nickname"], text=chunk,
+                           priority=PRIORITY_BULK)
+
+    def flush_all(self):
+        for user_id in list(self.buffers):
+            self.flush_user(user_id)
+        self.due = []
+        self.deadline = {}
+
+    async def _loop(self):
+        while True:
+            now = time.monotonic()
+            while self.due and self.due[0][0] <= now:
+                due, user_id = heapq.heappop(self.due)
+                if self.deadline.get(user_id) == due:   # иначе буфер уже ушёл, а этот — новый
+                    self.flush_user(user_id)
+            self.wakeup.clear()
+            timeout = self.due[0][0] - now if self.due else None
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self):
+        self.task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        """Остановить и не потерять накопленное: всё уходит в очередь отправки."""
+        if self.task:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.flush_all()
+
+
+digests = DigestScheduler()
+
+
+def chunk_lines(lines: list, limit: int) -> list:
+    """Склеить строки в сообщения не длиннее limit символов."""
+    chunks, current, size = [], [], 0
+    for line in lines:
+        if len(line) > limit:
+            line = line[:limit - 1] + "…"
+        if current and size + len(line) + 1 > limit:
+            chunks.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+def deliver_text(user_id: int, text: str, kind: str = "chat", batch: BroadcastBatch = None,
+                 post: int = None, reply_to: dict = None, priority: int = PRIORITY_CHAT):
+    """
+    Отправить текст пользователю сразу или положить в его дайджест.
+    post — пост в карте ответов, reply_to — его копии { chat_id: message_id },
+    на которые ответ ляжет в чате получателя.
+    Личное (ЛС, ответ, обнимашка) всегда идёт в полосе PRIORITY_DIRECT.
+    """
+    if digests.offer(user_id, kind, text):
+        return
+    info = users_in_chat[user_id]
+    chat_id = info["chat_id"]
+    extra = {}
+    if reply_to and chat_id in reply_to:
+        extra = {"reply_to_message_id": reply_to[chat_id], "allow_sending_without_reply": True}
+    outbox.enqueue(
+        chat_id,
+        "send_message",
+        label=info["nickname"],
+        on_sent=reply_map.recorder(post, chat_id) if post else None,
+        batch=batch,
+        priority=priority if kind == "chat" else PRIORITY_DIRECT,
+        text=text,
+        **extra
+    )
+
+
+# ------------------------------------------------------------------------
+# 5.5) ПАРКОВКА НЕАКТИВНЫХ (таймер-колесо по last_activity)
+# ------------------------------------------------------------------------
+IDLE_BUCKET = 60                                                    # сек на ячейку колеса
+PARK_AFTER = float(os.getenv("PARK_AFTER", "1800"))                 # сек; = 🌑 в /list
+PARK_DIGEST_INTERVAL = float(os.getenv("PARK_DIGEST_INTERVAL", "30"))  # мин между дайджестами
+AUTO_STOP_AFTER = float(os.getenv("AUTO_STOP_AFTER", "0"))          # сек; 0 — не выводить из чата
+
+
+class TimeWheel:
+    """
+    uid, разложенные по ячейкам (минутам) последней активности.
+    Перенос uid — O(1), выборка просроченных — по непустым ячейкам из кучи
+    номеров, а не по каждой минуте простоя.
+    """
+
+    def __init__(self):
+        self.buckets = {}   # { номер ячейки: {uid} }
+        self.where = {}     # { uid: номер ячейки }
+        self.keys = []      # куча номеров ячеек; опустевшие отбрасываются в pop_older
+
+    def put(self, uid: int, bucket: int):
+        self.remove(uid)
+        members = self.buckets.get(bucket)
+        if members is None:
+            members = self.buckets[bucket] = set()
+            heapq.heappush(self.keys, bucket)
+        members.add(uid)
+        self.where[uid] = bucket
+
+    def remove(self, uid: int):
+        bucket = self.where.pop(uid, None)
+        if bucket is None:
+            return None
+        members = self.buckets[bucket]
+        members.discard(uid)
+        if not members:
+            del self.buckets[bucket]
+        return bucket
+
+    def pop_older(self, limit: int) -> list:
+        """Вынуть всех из ячеек < limit: [(uid, ячейка)]."""
+        out = []
+        while self.keys and self.keys[0] < limit:
+            b = heapq.heappop(self.keys)
+            for uid in self.buckets.pop(b, ()):
+                del self.where[uid]
+                out.append((uid, b))
+        return out
+
+
+class IdleTracker:
+    """
+    Активные и «припаркованные» пользователи. Раз в минуту JobQueue зовёт
+    sweep(): кто молчит дольше PARK_AFTER — в парковку (сообщения чата им
+    идут дайджестом), кто дольше AUTO_STOP_AFTER — выводится из чата.
+    """
+
+    def __init__(self):
+        self.active = TimeWheel()
+        self.parked_wheel = TimeWheel()
+        self.parked = set()
+
+    def touch(self, uid: int, ts: float = None):
+        bucket = int((ts if ts is not None else time.time()) // IDLE_BUCKET)
+        if self.active.where.get(uid) == bucket:
+            return
+        if uid in self.parked:
+            self.parked.discard(uid)
+            self.parked_wheel.remove(uid)
+        self.active.put(uid, bucket)
+
+    def forget(self, uid: int):
+        self.active.remove(uid)
+        self.parked_wheel.remove(uid)
+        self.parked.discard(uid)
+
+    def sweep(self, now: float = None) -> list:
+        """Припарковать просроченных; вернуть uid тех, кого пора вывести из чата."""
+        now = now if now is not None else time.time()
+        for uid, bucket in self.active.pop_older(int((now - PARK_AFTER) // IDLE_BUCKET)):
+            self.parked.add(uid)
+            self.parked_wheel.put(uid, bucket)
+        if not AUTO_STOP_AFTER:
+            return []
+        expired = [uid for uid, _ in self.parked_wheel.pop_older(int((now - AUTO_STOP_AFTER) // IDLE_BUCKET))]
+        self.parked.difference_update(expired)
+        return expired
+
+
+idle_tracker = IdleTracker()
+
+
+async def idle_sweep_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue: парковка неактивных и автоматический /stop."""
+    gone = {}   # { room: ["код ник"] }
+    for uid in idle_tracker.sweep():
+        info = remove_from_chat(uid)
+        if info is None:
+            continue
+        gone.setdefault(info.get("room", DEFAULT_ROOM), []).append(f"{info['code']} {info['nickname']}")
+        outbox.enqueue(
+            info["chat_id"],
+            "send_message",
+            label=info["nickname"],
+            priority=PRIORITY_BULK,
+            text="[BOT] Тебя давно не было, и ты вышел из чата. Возвращайся в любой момент через /start."
+        )
+        logging.info(f"Пользователь {uid} («{info['nickname']}») выведен из чата по неактивности.")
+    for room, names in gone.items():
+        await broadcast_text(context.application, "[Bot] Вышли из чата по неактивности: " + ", ".join(names),
+                             room=room, priority=PRIORITY_BULK)
+
+
+def by_activity(uids) -> list:
+    """Получатели рассылки: сначала недавно активные — им доставим раньше."""
+    return sorted(uids, key=lambda uid: users_in_chat[uid]["last_activity"], reverse=True)
 
 
-# Широковещательная рассылка фото
-async def broadcast_photo(telegram_app, photo_file_id: str, caption: str = "", exclude_user: int = None):
-    """Рассылка фото всем, кроме exclude_user."""
-    for uid, info in users_in_chat.items():
+def record_broadcast(batch: BroadcastBatch):
+    """Метрики рассылки: сколько ушло в очередь и за сколько поставили."""
+    BROADCAST_ENQUEUE.observe(time.perf_counter() - batch.started)
+    BROADCAST_FANOUT.observe(batch.pending)
+
+
+# Широковещательная рассылка текста
+async def broadcast_text(telegram_app, text: str, exclude_user: int = None, kinds: dict = None,
+                         post: int = None, reply_to: dict = None, room: str = None,
+                         priority: int = PRIORITY_CHAT):
+    """
+    Ставим текст в очередь всем в комнате room (None — во всех), кроме exclude_user (не ждём отправки).
+    kinds: { uid: "reply" | "hug" } — для кого это ответ/обнимашка (см. /notify).
+    post, reply_to — см. deliver_text. Системные «вошёл/вышел» — priority=PRIORITY_BULK.
+    """
+    batch = BroadcastBatch()
+    for uid in by_activity(users_in_chat if room is None else room_members[room]):
         if uid == exclude_user:
             continue
-        try:
-            await telegram_app.bot.send_photo(
-                chat_id=info["chat_id"],
-                photo=photo_file_id,
-                caption=caption
-            )
-        except Exception as e:
-            logging.warning(f"Ошибка отправки фото {info['nickname']}: {e}")
+        deliver_text(uid, text, kinds.get(uid, "chat") if kinds else "chat", batch, post, reply_to,
+                     priority)
+    record_broadcast(batch)
 
 
 def parse_replied_nickname(bot_message_text: str) -> str:
@@ -179,6 +1641,733 @@ def parse_replied_nickname(bot_message_text: str) -> str:
     return m.group(1).strip()
 
 
+# ------------------------------------------------------------------------
+# 5.6) МЕДИА: АЛЬБОМЫ, СТИКЕРЫ / ГОЛОСОВЫЕ / ВИДЕО
+# ------------------------------------------------------------------------
+MEDIA_GROUP_WAIT = float(os.getenv("MEDIA_GROUP_WAIT", "1.0"))  # сек ждём остальные части альбома
+MEDIA_KINDS = ("photo", "video", "animation", "audio", "document", "voice", "video_note", "sticker")
+MEDIA_NAMES = {
+    "photo": "фото", "video": "видео", "animation": "гифку", "audio": "аудио",
+    "document": "файл", "voice": "голосовое", "video_note": "кружок", "sticker": "стикер",
+}
+CAPTIONLESS = {"sticker", "video_note"}   # подпись не поддерживается — шлём её отдельным текстом
+ALBUM_INPUTS = {
+    "photo": InputMediaPhoto,
+    "video": InputMediaVideo,
+    "audio": InputMediaAudio,
+    "document": InputMediaDocument,
+}
+
+
+def extract_media(message):
+    """(вид, file_id) вложения сообщения или None. У фото берём самый большой размер."""
+    for kind in MEDIA_KINDS:
+        media = getattr(message, kind, None)
+        if not media:
+            continue
+        if kind == "photo":
+            media = media[-1]
+        return kind, media.file_id
+    return None
+
+def media_header(sender_id: int, what: str, caption: str = "") -> str:
+    info = users_in_chat[sender_id]
+    header = f"{info['code']} {info['nickname']} прислал(а) {what}"
+    return f"{header}\n{caption}" if caption else header
+
+def broadcast_media(sender_id: int, kind: str, file_id: str, caption: str = "", post: int = None):
+    """Медиа всем, кроме отправителя, через очередь: send_<вид>(file_id, подпись)."""
+    header = media_header(sender_id, MEDIA_NAMES[kind], caption)
+    batch = BroadcastBatch()
+    for uid in by_activity(room_members[room_of(sender_id)]):
+        if uid == sender_id:
+            continue
+        info = users_in_chat[uid]
+        chat_id = info["chat_id"]
+        on_sent = reply_map.recorder(post, chat_id) if post else None
+        if kind in CAPTIONLESS:
+            outbox.enqueue(chat_id, "send_message", label=info["nickname"], batch=batch,
+                           priority=PRIORITY_CHAT, text=header)
+            outbox.enqueue(chat_id, f"send_{kind}", label=info["nickname"], on_sent=on_sent, batch=batch,
+                           priority=PRIORITY_CHAT, **{kind: file_id})
+        else:
+            outbox.enqueue(chat_id, f"send_{kind}", label=info["nickname"], on_sent=on_sent, batch=batch,
+                           priority=PRIORITY_CHAT, caption=header, **{kind: file_id})
+    record_broadcast(batch)
+    room_history[room_of(sender_id)].add(header.replace("\n", ": "), (file_id,) if kind == "photo" else ())
+
+def broadcast_album(sender_id: int, items: list, caption: str = ""):
+    """Альбом одним send_media_group на получателя; подпись — у первого элемента."""
+    media = [dict(item) for item in items]
+    media[0]["caption"] = media_header(sender_id, "альбом", caption)
+    batch = BroadcastBatch()
+    for uid in by_activity(room_members[room_of(sender_id)]):
+        if uid == sender_id:
+            continue
+        info = users_in_chat[uid]
+        outbox.enqueue(info["chat_id"], "send_media_group", label=info["nickname"], batch=batch,
+                       priority=PRIORITY_CHAT, media=media)
+    record_broadcast(batch)
+    room_history[room_of(sender_id)].add(
+        media[0]["caption"].replace("\n", ": "),
+        tuple(item["media"] for item in items if item["type"] == "photo")
+    )
+
+
+class AlbumBuffer:
+    """
+    Части альбома приходят отдельными апдейтами с одним media_group_id.
+    Копим их MEDIA_GROUP_WAIT секунд от первой части и рассылаем разом.
+    """
+
+    def __init__(self, wait: float):
+        self.wait = wait
+        self.albums = {}   # { media_group_id: {"sender": uid, "items": [...], "caption": str} }
+
+    def add(self, sender_id: int, group_id: str, kind: str, file_id: str, caption: str = ""):
+        album = self.albums.get(group_id)
+        if album is None:
+            album = self.albums[group_id] = {"sender": sender_id, "items": [], "caption": ""}
+            asyncio.get_running_loop().call_later(self.wait, self.flush, group_id)
+        album["items"].append({"type": kind, "media": file_id})
+        if caption and not album["caption"]:
+            album["caption"] = caption
+
+    def flush(self, group_id: str):
+        album = self.albums.pop(group_id, None)
+        if album and album["sender"] in users_in_chat:
+            broadcast_album(album["sender"], album["items"], album["caption"])
+
+    def flush_all(self):
+        for group_id in list(self.albums):
+            self.flush(group_id)
+
+
+albums = AlbumBuffer(MEDIA_GROUP_WAIT)
+
+
+# ------------------------------------------------------------------------
+# 5.7) КАРТА ОТВЕТОВ: (chat_id, message_id) -> АВТОР
+# ------------------------------------------------------------------------
+REPLY_MAP_SIZE = int(os.getenv("REPLY_MAP_SIZE", "100000"))   # копий сообщений в памяти
+
+
+class ReplyMap:
+    """
+    Пост — одно сообщение автора, разосланное всем. Для каждой копии
+    (chat_id, message_id) помним пост, для поста — автора и его копии по чатам:
+    ответ находит автора за O(1), а в чате каждого получателя ответ можно
+    привязать к его копии через reply_to_message_id.
+
+    Хранится не больше REPLY_MAP_SIZE копий, старые вытесняются. Рестарт
+    карта не переживает — для старых сообщений остаётся разбор ника из текста.
+    """
+
+    def __init__(self, size: int):
+        self.size = size
+        self.messages = collections.OrderedDict()   # { (chat_id << 32) | message_id: post_id }
+        self.posts = {}                             # { post_id: (author_id, { chat_id: message_id }) }
+        self.last_id = 0
+
+    @staticmethod
+    def _key(chat_id: int, message_id: int) -> int:
+        return (chat_id << 32) | message_id
+
+    def new_post(self, author_id: int, chat_id: int, message_id: int) -> int:
+        """Новый пост; исходное сообщение автора — его копия в чате автора."""
+        self.last_id += 1
+        self.posts[self.last_id] = (author_id, {})
+        self.add(self.last_id, chat_id, message_id)
+        return self.last_id
+
+    def add(self, post_id: int, chat_id: int, message_id: int):
+        post = self.posts.get(post_id)
+        if post is None or message_id is None:
+            return
+        post[1][chat_id] = message_id
+        self.messages[self._key(chat_id, message_id)] = post_id
+        while len(self.messages) > self.size:
+            key, old_id = self.messages.popitem(last=False)
+            old = self.posts.get(old_id)
+            if old is None:
+                continue
+            copies = old[1]
+            chat = key >> 32
+            if copies.get(chat) == key - (chat << 32):
+                del copies[chat]
+            if not copies:
+                del self.posts[old_id]
+
+    def recorder(self, post_id: int, chat_id: int):
+        """on_sent для очереди отправки: запомнить копию поста."""
+        def on_sent(msg):
+            self.add(post_id, chat_id, msg.message_id)
+        return on_sent
+
+    def lookup(self, chat_id: int, message_id: int):
+        """(автор, { chat_id: message_id }) для сообщения или None."""
+        key = self._key(chat_id, message_id)
+        post_id = self.messages.get(key)
+        if post_id is None:
+            return None
+        self.messages.move_to_end(key)
+        return self.posts.get(post_id)
+
+
+reply_map = ReplyMap(REPLY_MAP_SIZE)
+metrics.gauge("bot_reply_map_messages", "Копий сообщений в карте ответов.", lambda: len(reply_map.messages))
+
+
+# ------------------------------------------------------------------------
+# 5.8) ЗАЩИТА ОТ ФЛУДА: ЛИМИТЫ НА ВХОДЯЩИЕ
+# ------------------------------------------------------------------------
+# Каждое сообщение в чат — рассылка на всю комнату, поэтому один флудер может
+# выбрать весь SEND_GLOBAL_RATE. Лимитируем входящие по пользователю.
+FLOOD_RATE = float(os.getenv("FLOOD_RATE", "1"))        # сообщений/сек в чат на пользователя; 0 — без лимитов
+FLOOD_BURST = float(os.getenv("FLOOD_BURST", "5"))      # сколько можно подряд
+FLOOD_MERGE = os.getenv("FLOOD_MERGE", "1") == "1"      # склеивать лишние сообщения вместо отказа
+FLOOD_MERGE_MAX_CHARS = 3500                            # склейка не длиннее одного сообщения Telegram
+FLOOD_WARN_INTERVAL = 10.0                              # не чаще одного предупреждения за столько секунд
+# Команды, которые сами по себе рассылают/пишут другим: (в секунду, подряд)
+COMMAND_LIMITS = {
+    "poll": (1 / 60, 2),
+    "hug": (1 / 5, 3),
+    "msg": (1 / 2, 5),
+    "hold": (1 / 30, 3),   # сообщений на проверку: каждое — ЛС всем модераторам
+}
+
+THROTTLED = {
+    kind: metrics.counter("bot_throttled_total", "Входящих, упёршихся в лимит.", kind=kind)
+    for kind in ("chat", *COMMAND_LIMITS)
+}
+MERGED = metrics.counter("bot_merged_messages_total", "Сообщений, склеенных с предыдущими из-за лимита.")
+
+
+class FloodGuard:
+    """
+    Токен-бакет на пользователя для каждого вида входящих (chat, poll, hug, msg, hold).
+    Бакеты заводятся лениво и удаляются при выходе из чата.
+    """
+
+    def __init__(self, limits: dict):
+        self.limits = limits                      # { kind: (rate, burst) }
+        self.buckets = {kind: {} for kind in limits}
+        self.warned = {}                          # { uid: когда предупреждали (monotonic) }
+
+    def bucket(self, user_id: int, kind: str):
+        rate, burst = self.limits.get(kind, (0, 0))
+        if not rate:
+            return None
+        buckets = self.buckets[kind]
+        bucket = buckets.get(user_id)
+        if bucket is None:
+            bucket = buckets[user_id] = TokenBucket(rate, burst)
+        return bucket
+
+    def check(self, user_id: int, kind: str) -> float:
+        """0 — можно; иначе сколько секунд ждать (и событие в метриках)."""
+        bucket = self.bucket(user_id, kind)
+        wait = bucket.take() if bucket else 0.0
+        if wait:
+            THROTTLED[kind].inc()
+        return wait
+
+    def forget(self, user_id: int):
+        for buckets in self.buckets.values():
+            buckets.pop(user_id, None)
+        self.warned.pop(user_id, None)
+
+    async def warn(self, update: Update, wait: float):
+        """Сказать флудеру подождать — но не чаще раза в FLOOD_WARN_INTERVAL."""
+        now = time.monotonic()
+        user_id = update.effective_user.id
+        if now - self.warned.get(user_id, -FLOOD_WARN_INTERVAL) < FLOOD_WARN_INTERVAL:
+            return
+        self.warned[user_id] = now
+        await update.effective_message.reply_text(
+            f"[BOT] Слишком часто. Подожди {max(1, round(wait))} сек."
+        )
+
+    def limit(self, kind: str):
+        """Декоратор для входа в команду: при превышении — предупреждение и END."""
+        def decorator(callback):
+            @functools.wraps(callback)
+            async def limited(update, context):
+                user_id = update.effective_user.id
+                wait = self.check(user_id, kind) if user_id in users_in_chat else 0.0
+                if wait:
+                    await self.warn(update, wait)
+                    return ConversationHandler.END
+                return await callback(update, context)
+            return limited
+        return decorator
+
+
+flood_guard = FloodGuard({"chat": (FLOOD_RATE, FLOOD_BURST), **COMMAND_LIMITS} if FLOOD_RATE else {})
+
+
+class ChatMerger:
+    """
+    Сообщения сверх лимита не теряются, а копятся и уходят одной рассылкой,
+    когда в бакете появится токен: флудер получает ту же долю отправок,
+    что и все, а обычные сообщения не задерживаются. Пока у пользователя
+    что-то копится, новые сообщения встают в ту же склейку (порядок сохраняется).
+    """
+
+    def __init__(self, guard: FloodGuard):
+        self.guard = guard
+        self.pending = {}   # { uid: {"lines": [...], "chars": int, "room", "post", "reply_to", "kinds"} }
+
+    def add(self, user_id: int, text: str, wait: float, **broadcast_args) -> bool:
+        """Добавить в склейку. False — склейка переполнена, сообщение не принято."""
+        entry = self.pending.get(user_id)
+        if entry is None:
+            entry = self.pending[user_id] = dict(lines=[], chars=0, **broadcast_args)
+            asyncio.get_running_loop().call_later(wait, self.flush, user_id)
+        elif entry["chars"] + len(text) > FLOOD_MERGE_MAX_CHARS:
+            return False
+        else:
+            MERGED.inc()
+        entry["lines"].append(text)
+        entry["chars"] += len(text) + 1
+        return True
+
+    def flush(self, user_id: int, force: bool = False):
+        entry = self.pending.get(user_id)
+        if entry is None:
+            return
+        if user_id not in users_in_chat:
+            del self.pending[user_id]
+            return
+        wait = 0.0 if force else self.guard.check(user_id, "chat")
+        if wait:
+            asyncio.get_running_loop().call_later(wait, self.flush, user_id)
+            return
+        del self.pending[user_id]
+        batch = BroadcastBatch()
+        text = "\n".join(entry["lines"])
+        kinds = entry["kinds"]
+        for uid in by_activity(room_members[entry["room"]]):
+            if uid != user_id:
+                deliver_text(uid, text, kinds.get(uid, "chat") if kinds else "chat", batch,
+                             entry["post"], entry["reply_to"])
+        record_broadcast(batch)
+
+    def flush_all(self):
+        """При остановке: разослать всё накопленное, не дожидаясь лимита."""
+        for user_id in list(self.pending):
+            self.flush(user_id, force=True)
+
+
+chat_merger = ChatMerger(flood_guard)
+metrics.gauge("bot_merge_pending_users", "Пользователей с отложенной склейкой сообщений.",
+              lambda: len(chat_merger.pending))
+
+
+# ------------------------------------------------------------------------
+# 5.9) НЕДАВНЯЯ ИСТОРИЯ КОМНАТ: /last И «ПОКА ТЕБЯ НЕ БЫЛО»
+# ------------------------------------------------------------------------
+HISTORY_SIZE = int(os.getenv("HISTORY_SIZE", "10000"))   # сообщений на комнату
+CATCHUP_MAX = int(os.getenv("CATCHUP_MAX", "50"))        # пропущенных строк вернувшемуся; 0 — не слать
+CATCHUP_NEW = int(os.getenv("CATCHUP_NEW", "10"))        # последних строк новичку и при смене комнаты
+LAST_PAGE_SIZE = 20                                     # строк на страницу /last
+LAST_LINE_LIMIT = 180                                   # длинные сообщения в /last обрезаем: страница — одно сообщение
+CATCHUP_PHOTOS = 10                                     # фото в догоняющем альбоме (лимит send_media_group)
+
+
+class RoomHistory:
+    """
+    Кольцевой буфер последних сообщений комнаты (только в памяти).
+    Время — в array('d'), строки — в заранее выделенном списке, file_id фото —
+    в отдельном словаре по позиции (фото редки): 10 000 строк по ~60 символов — около 3 МБ.
+    Позиции логические: 0 — самое старое из хранимых.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.times = array.array("d", bytes(8 * capacity))
+        self.lines = [None] * capacity
+        self.photos = {}   # { физическая ячейка: (file_id, ...) }
+        self.count = 0     # сколько добавлено за всё время
+
+    def __len__(self):
+        return min(self.count, self.capacity)
+
+    def _slot(self, i: int) -> int:
+        return (self.count - len(self) + i) % self.capacity
+
+    def add(self, line: str, photos: tuple = ()):
+        slot = self.count % self.capacity
+        self.times[slot] = time.time()
+        self.lines[slot] = line
+        self.photos.pop(slot, None)
+        if photos:
+            self.photos[slot] = photos
+        self.count += 1
+
+    def render(self, i: int) -> str:
+        slot = self._slot(i)
+        return f"{time.strftime('%H:%M', time.localtime(self.times[slot]))} {self.lines[slot]}"
+
+    def since(self, ts: float) -> int:
+        """Первая позиция с сообщением новее ts (бинарный поиск по кольцу)."""
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.times[self._slot(mid)] <= ts:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def page(self, page: int, size: int):
+        """Строки страницы page (0 — самые новые) по порядку и число страниц."""
+        total = len(self)
+        pages = max(1, (total + size - 1) // size)
+        page = max(0, min(page, pages - 1))
+        end = total - page * size
+        return [self.render(i) for i in range(max(0, end - size), end)], page, pages
+
+    def photos_from(self, start: int, limit: int) -> list:
+        """Последние не больше limit file_id фото начиная с позиции start."""
+        found = []
+        for i in range(len(self) - 1, start - 1, -1):
+            found[:0] = self.photos.get(self._slot(i), ())
+            if len(found) >= limit:
+                return found[-limit:]
+        return found
+
+
+room_history = {room: RoomHistory(HISTORY_SIZE) for room in ROOMS}
+metrics.gauge("bot_history_messages", "Сообщений в истории всех комнат.",
+              lambda: sum(len(h) for h in room_history.values()))
+
+
+def send_catchup(user_id: int, room: str, since: float = None):
+    """
+    Догнать разговор: since — время ухода (вернувшемуся — пропущенное),
+    None — просто последние CATCHUP_NEW строк. Строки склеены в несколько
+    сообщений, фото — одним альбомом.
+    """
+    history = room_history[room]
+    limit = CATCHUP_MAX if since is not None else CATCHUP_NEW
+    if not limit or not len(history):
+        return
+    start = history.since(since) if since is not None else 0
+    first = max(start, len(history) - limit)
+    if first >= len(history):
+        return
+    info = users_in_chat[user_id]
+    header = (f"[BOT] Пока тебя не было ({len(history) - start}):" if since is not None
+              else "[BOT] Последнее в комнате:")
+    lines = [header] + [history.render(i) for i in range(first, len(history))]
+    if first > start:
+        lines.append(f"…и раньше ещё {first - start} — /last")
+    for chunk in chunk_lines(lines, MESSAGE_LIMIT):
+        outbox.enqueue(info["chat_id"], "send_message", label=info["nickname"], text=chunk)
+    photos = history.photos_from(first, CATCHUP_PHOTOS)
+    if len(photos) == 1:
+        outbox.enqueue(info["chat_id"], "send_photo", label=info["nickname"], photo=photos[0])
+    elif photos:
+        outbox.enqueue(info["chat_id"], "send_media_group", label=info["nickname"],
+                       media=[{"type": "photo", "media": file_id} for file_id in photos])
+
+
+# ------------------------------------------------------------------------
+# 5.10) ФИЛЬТР ТРИГГЕРОВ (Ахо — Корасик)
+# ------------------------------------------------------------------------
+# Файл фраз перечитывается на ходу, если поменялся (раз в TRIGGERS_RELOAD_INTERVAL).
+TRIGGERS_FILE = os.getenv("TRIGGERS_FILE", os.path.join(os.path.dirname(os.path.abspath(__file__)), "triggers.txt"))
+TRIGGERS_RELOAD_INTERVAL = float(os.getenv("TRIGGERS_RELOAD_INTERVAL", "30"))
+TRIGGER_NOTICE_INTERVAL = 60.0   # напоминание о правилах автору — не чаще раза в минуту
+HELD_MAX = 1000   # сообщений на проверке у модераторов; старые выбрасываем
+
+TRIGGER_ACTIONS = ("warn", "mask", "hold")   # по возрастанию строгости
+FILTER_SECONDS = metrics.histogram("bot_filter_seconds", "Проверка сообщения фильтром триггеров.",
+                                   (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01))
+FILTER_HITS = {
+    action: metrics.counter("bot_filter_actions_total", "Сообщений, на которые сработал фильтр.", action=action)
+    for action in TRIGGER_ACTIONS
+}
+
+# Нормализация 1:1 по символам (позиции совпадают с исходным текстом): регистр, ё/е,
+# латинские двойники кириллицы, любая цифра — «#».
+_NORMALIZE = str.maketrans(
+    "ёaeopcxykmthb0123456789",
+    "еаеорсхукмтнв##########",
+)
+_NUMBER_GLUE = " .,"   # разделители внутри числа: 1 200, 1.5, 1,5
+
+
+def normalize_trigger_text(text: str) -> str:
+    lowered = text.lower()
+    if len(lowered) != len(text):   # редкие символы, у которых lower() меняет длину
+        lowered = "".join(ch.lower()[0] for ch in text)
+    return lowered.translate(_NORMALIZE)
+
+
+class TriggerPattern:
+    __slots__ = ("phrase", "action", "stem", "length")
+
+    def __init__(self, phrase: str, action: str, stem: bool, length: int):
+        self.phrase = phrase   # как в файле — для модераторов
+        self.action = action
+        self.stem = stem       # «калори*»: после совпадения — любое окончание слова
+        self.length = length   # длина нормализованной фразы
+
+
+class TriggerMatch:
+    __slots__ = ("action", "spans", "phrases")
+
+    def __init__(self):
+        self.action = None     # самое строгое из сработавших
+        self.spans = []        # [(начало, конец)] для mask, в индексах исходного текста
+        self.phrases = []
+
+
+class TriggerAutomaton:
+    """
+    Автомат Ахо — Корасик по нормализованным фразам: сообщение проверяется
+    за один проход по символам при любом числе фраз. Цифры схлопываются в
+    «#», поэтому «#» в фразе — любое число. Фраза должна начинаться с начала
+    слова и (если без «*») заканчиваться концом слова.
+    """
+
+    def __init__(self, entries: list):
+        self.goto = [{}]      # состояние -> { символ: состояние }
+        self.fail = [0]
+        self.out = [()]       # состояние -> (индексы фраз), включая найденные по fail-ссылкам
+        self.patterns = []
+        for action, phrase in entries:
+            stem = phrase.endswith("*")
+            key = " ".join(normalize_trigger_text(phrase.rstrip("*")).split())
+            key = re.sub("#+ ?", "#", key)   # «45 кг» и «45кг» — одно и то же
+            if not key:
+                continue
+            self.patterns.append(TriggerPattern(phrase, action, stem, len(key)))
+            self._insert(key, len(self.patterns) - 1)
+        self._link()
+
+    def __len__(self):
+        return len(self.patterns)
+
+    def _insert(self, key: str, index: int):
+        state = 0
+        for ch in key:
+            nxt = self.goto[state].get(ch)
+            if nxt is None:
+                nxt = self.goto[state][ch] = len(self.goto)
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(())
+            state = nxt
+        self.out[state] += (index,)
+
+    def _link(self):
+        """fail-ссылки обходом в ширину."""
+        queue_ = collections.deque(self.goto[0].values())
+        while queue_:
+            state = queue_.popleft()
+            for ch, nxt in self.goto[state].items():
+                queue_.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch, 0)
+                self.out[nxt] += self.out[self.fail[nxt]]
+
+    def scan(self, text: str):
+        """TriggerMatch для текста или None, если ничего не нашли."""
+        if not self.patterns:
+            return None
+        norm = normalize_trigger_text(text)
+        n = len(norm)
+        goto, fail, out = self.goto, self.fail, self.out
+        pos = []         # позиции принятых символов в исходном тексте
+        prev = ""
+        state = 0
+        result = None
+        for i, ch in enumerate(norm):
+            # Число — один символ «#»: пропускаем следующие цифры, разделители внутри числа
+            # и пробел после него
+            if prev == "#" and (ch == "#" or ch.isspace() or
+                                (ch in _NUMBER_GLUE and i + 1 < n and norm[i + 1] == "#")):
+                continue
+            if ch.isspace():
+                if prev == " ":
+                    continue
+                ch = " "
+            pos.append(i)
+            prev = ch
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch, 0)
+            if not out[state]:
+                continue
+            for index in out[state]:
+                pattern = self.patterns[index]
+                start = pos[len(pos) - pattern.length]
+                end = i + 1
+                if start and norm[start - 1].isalnum():
+                    continue   # не с начала слова
+                if norm[end - 1] == "#":
+                    while end < n and (norm[end] == "#" or (norm[end] in _NUMBER_GLUE and end + 1 < n
+                                                            and norm[end + 1] == "#")):
+                        end += 1
+                if pattern.stem:
+                    while end < n and norm[end].isalnum():
+                        end += 1
+                elif end < n and norm[end].isalnum():
+                    continue   # не до конца слова
+                if result is None:
+                    result = TriggerMatch()
+                if result.action is None or TRIGGER_ACTIONS.index(pattern.action) > TRIGGER_ACTIONS.index(result.action):
+                    result.action = pattern.action
+                if pattern.action == "mask":
+                    result.spans.append((start, end))
+                result.phrases.append(pattern.phrase)
+        return result
+
+
+def load_trigger_entries(path: str) -> list:
+    """Строки «действие фраза»; # в начале строки — комментарий."""
+    entries = []
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, start=1):
+            line = line.strip()
+            if not line or line.startswith("#"):
+                continue
+            action, _, phrase = line.partition(" ")
+            if action not in TRIGGER_ACTIONS or not phrase.strip() or "*" in phrase.strip()[:-1]:
+                logging.warning(f"{path}:{lineno}: не понял строку «{line}» — пропускаю.")
+                continue
+            entries.append((action, phrase.strip()))
+    return entries
+
+
+def mask_spans(text: str, spans: list) -> str:
+    """
+    Заменить совпадения звёздочками: если в совпадении есть цифры — только их
+    («вешу **,*»), иначе слово целиком, кроме первой буквы («к*******»).
+    """
+    chars = list(text)
+    for start, end in spans:
+        digits = any(ch.isdigit() for ch in text[start:end])
+        for j in range(start, end):
+            if chars[j].isdigit() if digits else (j > start and not chars[j].isspace()):
+                chars[j] = "*"
+    return "".join(chars)
+
+
+class TriggerFilter:
+    """Текущий автомат + горячая перезагрузка: новый собираем в потоке и подменяем ссылку."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.automaton = TriggerAutomaton([])
+        self.mtime = None
+        self.noticed = {}   # { uid: когда напоминали о правилах (monotonic) }
+
+    def load(self):
+        """Синхронная загрузка (при старте)."""
+        try:
+            self.mtime = os.stat(self.path).st_mtime
+        except OSError:
+            logging.info(f"Файла фраз {self.path} нет — фильтр триггеров выключен.")
+            return
+        started = time.perf_counter()
+        self.automaton = TriggerAutomaton(load_trigger_entries(self.path))
+        logging.info(f"Фильтр триггеров: {len(self.automaton)} фраз, "
+                     f"автомат собран за {time.perf_counter() - started:.3f}с.")
+
+    async def reload_if_changed(self):
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return
+        if mtime == self.mtime:
+            return
+        loop = asyncio.get_running_loop()
+        try:
+            entries = await loop.run_in_executor(None, load_trigger_entries, self.path)
+            automaton = await loop.run_in_executor(None, TriggerAutomaton, entries)
+        except Exception as e:
+            logging.warning(f"Не удалось перечитать {self.path}: {e}")
+            return
+        self.mtime = mtime
+        self.automaton = automaton
+        logging.info(f"Фильтр триггеров перечитан: {len(automaton)} фраз.")
+
+    def check(self, text: str):
+        started = time.perf_counter()
+        match = self.automaton.scan(text)
+        FILTER_SECONDS.observe(time.perf_counter() - started)
+        if match:
+            FILTER_HITS[match.action].inc()
+        return match
+
+    def should_notice(self, user_id: int) -> bool:
+        now = time.monotonic()
+        if now - self.noticed.get(user_id, -TRIGGER_NOTICE_INTERVAL) < TRIGGER_NOTICE_INTERVAL:
+            return False
+        self.noticed[user_id] = now
+        return True
+
+
+trigger_filter = TriggerFilter(TRIGGERS_FILE)
+metrics.gauge("bot_trigger_patterns", "Фраз в фильтре триггеров.", lambda: len(trigger_filter.automaton))
+
+
+async def trigger_reload_job(context: ContextTypes.DEFAULT_TYPE):
+    """JobQueue: перечитать файл фраз, если он изменился."""
+    await trigger_filter.reload_if_changed()
+
+
+class HeldMessages:
+    """
+    Сообщения на проверке (hold): уходят модераторам с кнопками
+    «пропустить / удалить», в чат — только после одобрения.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.items = collections.OrderedDict()   # { hold_id: {...} }
+        self.last_id = 0
+
+    def add(self, sender_id: int, room: str, phrases: list, **content) -> int:
+        self.last_id += 1
+        self.items[self.last_id] = dict(sender=sender_id, room=room, **content)
+        if len(self.items) > self.limit:
+            self.items.popitem(last=False)
+        info = users_in_chat[sender_id]
+        if "text" in content:
+            preview = content["text"]
+        elif "poll" in content:
+            preview = f"[опрос]\n{content['poll']}"
+        elif "nick" in content:
+            preview = f"[новый ник] {content['nick']}"
+        else:
+            preview = f"[{MEDIA_NAMES[content['kind']]}] {content.get('caption', '')}"
+        text = (f"[BOT] На проверке #{self.last_id}: {info['code']} {info['nickname']}"
+                + (f" в «{ROOMS[room]}»" if len(ROOMS) > 1 else "")
+                + f"\nСработало: {', '.join(dict.fromkeys(phrases))}\n\n{preview}")
+        markup = InlineKeyboardMarkup([[
+            InlineKeyboardButton("✅ Пропустить", callback_data=f"mod|ok|{self.last_id}"),
+            InlineKeyboardButton("❌ Удалить", callback_data=f"mod|no|{self.last_id}"),
+        ]])
+        for uid in admin_ids | moderator_ids:
+            outbox.enqueue(uid, "send_message", label=f"модерация #{self.last_id}",
+                           text=text[:MESSAGE_LIMIT], reply_markup=markup)
+        return self.last_id
+
+    def take(self, hold_id: int):
+        return self.items.pop(hold_id, None)
+
+
+held_messages = HeldMessages(HELD_MAX)
+metrics.gauge("bot_held_messages", "Сообщений ждут модератора.", lambda: len(held_messages.items))
+
+
 # ------------------------------------------------------------------------
 # 6) ХЕНДЛЕРЫ КОМАНД: /start, /stop
 # ------------------------------------------------------------------------
@@ -187,6 +2376,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
 
     ensure_user_in_dicts(user_id)
+    outbox.revive(chat_id)
 
     if user_id in users_in_chat:
         nickname = users_in_chat[user_id]["nickname"]
@@ -213,13 +2403,23 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         }
         join_count = 1
 
-    # Вставляем в активный список
+    # Вставляем в активный список — в комнату, где был в прошлый раз
+    room = users_history[user_id].get("room")
+    if room not in ROOMS:
+        room = DEFAULT_ROOM
     users_in_chat[user_id] = {
         "nickname": nickname,
         "code": code,
         "chat_id": chat_id,
-        "last_activity": datetime.datetime.now()
+        "last_activity": datetime.datetime.now(),
+        "room": room
     }
+    room_members[room][user_id] = None
+    user_registry.add(user_id, nickname, code)
+    roster_changed(user_id)
+    idle_tracker.touch(user_id)
+    state_store.mark("users_in_chat", user_id)
+    state_store.mark("users_history", user_id)
 
     # Приветственное сообщение
     await update.message.reply_text(
@@ -227,17 +2427,22 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Чтобы выйти — /stop.\n\n"
         f"Твой ник: {nickname}\n"
         f"Твой код: {code}\n"
-        "Приятного общения!"
+        + (f"Комната: {ROOMS[room]} (сменить — /room)\n" if len(ROOMS) > 1 else "")
+        + "Приятного общения!"
     )
 
+    # Что было в комнате: вернувшемуся — пропущенное, новичку — последние сообщения
+    send_catchup(user_id, room, users_history[user_id].get("left_at") if join_count > 1 else None)
+
     # Сообщение в общий чат о входе
     if join_count == 1:
         msg_broadcast = f"[Bot] {code} {nickname} входит в чат. Он новенький!"
     else:
         msg_broadcast = f"[Bot] {code} {nickname} входит в чат."
 
-    await broadcast_text(context.application, msg_broadcast, exclude_user=user_id)
-    logging.info(f"Пользователь {user_id} => {nickname} (join_count={join_count}).")
+    await broadcast_text(context.application, msg_broadcast, exclude_user=user_id, room=room,
+                         priority=PRIORITY_BULK)
+    logging.info(f"Пользователь {user_id} => {nickname} (join_count={join_count}, комната {room}).")
 
 
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -246,16 +2451,13 @@ async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("[BOT] Тебя нет в чате. Используй /start, чтобы войти.")
         return
 
-    nickname = users_in_chat[user_id]["nickname"]
-    code = users_in_chat[user_id]["code"]
-    users_in_chat.pop(user_id, None)
-
-    parted_users.insert(0, (nickname, code, datetime.datetime.now()))
-    if len(parted_users) > 20:
-        parted_users.pop()
+    info = remove_from_chat(user_id)
+    nickname = info["nickname"]
+    code = info["code"]
 
     await update.message.reply_text("[BOT] Ты вышел из чата. Возвращайся в любой момент через /start.")
-    await broadcast_text(context.application, f"[Bot] {code} {nickname} вышел из чата.", exclude_user=user_id)
+    await broadcast_text(context.application, f"[Bot] {code} {nickname} вышел из чата.", exclude_user=user_id,
+                         room=info.get("room", DEFAULT_ROOM), priority=PRIORITY_BULK)
     logging.info(f"Пользователь {user_id} («{nickname}») вышел из чата.")
 
 
@@ -284,47 +2486,262 @@ async def nick_new_name(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("[BOT] Ник слишком длинный (макс 15 символов).")
         return ConversationHandler.END
 
+    # Ник видят все в комнате — тот же фильтр триггеров, что и у сообщений
+    new_nick, verdict = await screen_text(update, user_id, new_nick)
+    if verdict and verdict.action == "hold":
+        await hold_message(update, user_id, verdict, nick=new_nick)
+        return ConversationHandler.END
+
+    await update.message.reply_text(f"[BOT] Новый ник: {new_nick}.")
+    await apply_nick(context.application, user_id, new_nick)
+    update_last_activity(user_id)
+    return ConversationHandler.END
+
+async def apply_nick(telegram_app, user_id: int, new_nick: str):
+    """Сменить ник и объявить об этом в комнате (из /nick и после одобрения модератором)."""
     old_nick = users_in_chat[user_id]["nickname"]
     code = users_in_chat[user_id]["code"]
 
     users_in_chat[user_id]["nickname"] = new_nick
     users_history[user_id]["nickname"] = new_nick
+    user_registry.rename(user_id, new_nick)
+    roster_changed(user_id)
+    state_store.mark("users_in_chat", user_id)
+    state_store.mark("users_history", user_id)
 
-    await update.message.reply_text(f"[BOT] Новый ник: {new_nick}.")
-    await broadcast_text(context.application, f"[Bot] {code} {old_nick} сменил(а) ник на {new_nick}.")
-    update_last_activity(user_id)
+    await broadcast_text(telegram_app, f"[Bot] {code} {old_nick} сменил(а) ник на {new_nick}.",
+                         room=room_of(user_id), priority=PRIORITY_BULK)
     logging.info(f"{user_id} сменил ник с {old_nick} на {new_nick}.")
-    return ConversationHandler.END
 
 async def nick_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("[BOT] Отменено.")
     return ConversationHandler.END
 
 
-# ------------------------------------------------------------------------
-# 8) /list, /last
-# ------------------------------------------------------------------------
-async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if not users_in_chat:
-        await update.message.reply_text("[BOT] В чате никого нет.")
+# ------------------------------------------------------------------------
+# 8) /list, /last
+# ------------------------------------------------------------------------
+LIST_PAGE_SIZE = int(os.getenv("LIST_PAGE_SIZE", "40"))   # строк на страницу /list
+LIST_REFRESH = 30.0   # сек; чаще «луны» пересчитывать смысла нет — минимальный шаг 60 сек
+MOON_ORDER = {m: i for i, m in enumerate("🌕🌖🌗🌘🌑")}
+
+
+class UserListCache:
+    """
+    Снимок /list, разбитый на страницы.
+    Строка «роль код ник» кэшируется на пользователя и сбрасывается только
+    при входе/выходе/смене ника; страницы пересобираются из этих строк,
+    когда снимок устарел (LIST_REFRESH) или состав чата поменялся.
+    Сортировки: "j" — по порядку входа, "a" — по активности (фазе луны).
+    """
+
+    def __init__(self):
+        self.lines = {}       # { uid: "роль код ник" }
+        self.snapshots = {}   # { (room, sort): (время сборки, [страницы]) }
+
+    def invalidate(self, user_id: int = None):
+        if user_id is not None:
+            self.lines.pop(user_id, None)
+        self.snapshots.clear()
+
+    def pages(self, room: str, sort: str) -> list:
+        snap = self.snapshots.get((room, sort))
+        if snap and time.monotonic() - snap[0] < LIST_REFRESH:
+            return snap[1]
+        pages = self._build(room, sort)
+        self.snapshots[(room, sort)] = (time.monotonic(), pages)
+        return pages
+
+    def _build(self, room: str, sort: str) -> list:
+        now = datetime.datetime.now()
+        rows = []
+        for uid in room_members[room]:
+            data = users_in_chat[uid]
+            line = self.lines.get(uid)
+            if line is None:
+                line = self.lines[uid] = f"{get_user_role(uid)} {data['code']} {data['nickname']}"
+            moon = get_moon_symbol((now - data["last_activity"]).total_seconds())
+            rows.append((moon, line))
+        if sort == "a":
+            rows.sort(key=lambda r: MOON_ORDER[r[0]])
+        lines = [f"{moon} {line}" for moon, line in rows]
+        return ["\n".join(lines[i:i + LIST_PAGE_SIZE]) for i in range(0, len(lines), LIST_PAGE_SIZE)]
+
+
+user_list_cache = UserListCache()
+
+
+def render_list_page(room: str, sort: str, page: int):
+    """Текст и клавиатура страницы /list комнаты room из кэшированного снимка."""
+    total_possible = 100  # Шутливое число из исходного кода :)
+    pages = user_list_cache.pages(room, sort)
+    page = max(0, min(page, len(pages) - 1))
+    if len(ROOMS) > 1:
+        text = (f"[BOT] В комнате «{ROOMS[room]}» {len(room_members[room])} "
+                f"(всего в чате {len(users_in_chat)}):\n" + pages[page])
+    else:
+        text = f"[BOT] В чате {len(users_in_chat)} (из {total_possible}):\n" + pages[page]
+
+    nav = []
+    if len(pages) > 1:
+        if page > 0:
+            nav.append(InlineKeyboardButton("◀️", callback_data=f"list|{sort}|{page - 1}"))
+        nav.append(InlineKeyboardButton(f"{page + 1}/{len(pages)}", callback_data=f"list|{sort}|{page}"))
+        if page < len(pages) - 1:
+            nav.append(InlineKeyboardButton("▶️", callback_data=f"list|{sort}|{page + 1}"))
+    if sort == "a":
+        toggle = InlineKeyboardButton("По входу", callback_data="list|j|0")
+    else:
+        toggle = InlineKeyboardButton("🌕 По активности", callback_data="list|a|0")
+    kb = [nav, [toggle]] if nav else [[toggle]]
+    return text, InlineKeyboardMarkup(kb)
+
+def list_room(user_id: int) -> str:
+    """Комната для /list: своя, а не вошедшим — комната по умолчанию."""
+    return room_of(user_id) if user_id in users_in_chat else DEFAULT_ROOM
+
+async def list_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    room = list_room(update.effective_user.id)
+    if not room_members[room]:
+        await update.message.reply_text("[BOT] В чате никого нет.")
+        return
+
+    text, kb = render_list_page(room, "j", 0)
+    await update.message.reply_text(text, reply_markup=kb)
+    update_last_activity(update.effective_user.id)
+
+async def list_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    parts = query.data.split("|")
+    if len(parts) != 3 or parts[1] not in ("j", "a") or not parts[2].isdigit():
+        await query.answer("Ошибка.")
+        return
+    room = list_room(update.effective_user.id)
+    if not room_members[room]:
+        await query.answer("В чате никого нет.")
+        return
+
+    text, kb = render_list_page(room, parts[1], int(parts[2]))
+    try:
+        await query.message.edit_text(text, reply_markup=kb)
+    except BadRequest:
+        pass  # страница не изменилась
+    await query.answer()
+    update_last_activity(update.effective_user.id)
+
+
+def render_last_page(room: str, page: int):
+    """Страница /last: page 0 — самые новые сообщения комнаты."""
+    lines, page, pages = room_history[room].page(page, LAST_PAGE_SIZE)
+    lines = [line if len(line) <= LAST_LINE_LIMIT else line[:LAST_LINE_LIMIT - 1] + "…" for line in lines]
+    text = f"[BOT] Недавнее в комнате ({page + 1}/{pages}):\n" + "\n".join(lines)
+    nav = []
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("◀️ Раньше", callback_data=f"last|{page + 1}"))
+    if page > 0:
+        nav.append(InlineKeyboardButton("Позже ▶️", callback_data=f"last|{page - 1}"))
+    return text, InlineKeyboardMarkup([nav]) if nav else None
+
+async def last_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in users_in_chat:
+        await update.message.reply_text("[BOT] Тебя нет в чате. /start, чтобы войти.")
+        return
+    room = room_of(user_id)
+    if not len(room_history[room]):
+        await update.message.reply_text("[BOT] В комнате пока тихо.")
+        return
+
+    text, kb = render_last_page(room, 0)
+    await update.message.reply_text(text, reply_markup=kb)
+    update_last_activity(user_id)
+
+async def last_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    parts = query.data.split("|")
+    if user_id not in users_in_chat or len(parts) != 2 or not parts[1].isdigit():
+        await query.answer("Ошибка.")
+        return
+    room = room_of(user_id)
+    if not len(room_history[room]):
+        await query.answer("В комнате пока тихо.")
+        return
+
+    text, kb = render_last_page(room, int(parts[1]))
+    try:
+        await query.message.edit_text(text, reply_markup=kb)
+    except BadRequest:
+        pass  # страница не изменилась
+    await query.answer()
+
+
+# ------------------------------------------------------------------------
+# 8.1) КОМНАТЫ /room
+# ------------------------------------------------------------------------
+def build_rooms_keyboard(current: str):
+    kb = []
+    for key, title in ROOMS.items():
+        mark = "✅ " if key == current else ""
+        kb.append([InlineKeyboardButton(f"{mark}{title} ({len(room_members[key])})", callback_data=f"room|{key}")])
+    return InlineKeyboardMarkup(kb)
+
+async def switch_room(telegram_app, user_id: int, room: str) -> str:
+    """Перевести в комнату и объявить об этом в старой и новой. Вернёт ответ пользователю."""
+    old = room_of(user_id)
+    if room == old:
+        return f"[BOT] Ты уже в комнате «{ROOMS[room]}»."
+    info = users_in_chat[user_id]
+    move_to_room(user_id, room)
+    who = f"{info['code']} {info['nickname']}"
+    await broadcast_text(telegram_app, f"[Bot] {who} переходит в комнату «{ROOMS[room]}».",
+                         exclude_user=user_id, room=old, priority=PRIORITY_BULK)
+    await broadcast_text(telegram_app, f"[Bot] {who} входит в комнату.", exclude_user=user_id, room=room,
+                         priority=PRIORITY_BULK)
+    update_last_activity(user_id)
+    send_catchup(user_id, room)
+    return f"[BOT] Ты в комнате «{ROOMS[room]}», здесь {len(room_members[room])} чел."
+
+async def room_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    user_id = update.effective_user.id
+    if user_id not in users_in_chat:
+        await update.message.reply_text("[BOT] Тебя нет в чате. /start, чтобы войти.")
         return
 
-    total_possible = 100  # Шутливое число из исходного кода :)
-    lines = []
-    now = datetime.datetime.now()
+    # /room КЛЮЧ — сразу перейти
+    if context.args:
+        room = context.args[0]
+        if room not in ROOMS:
+            names = ", ".join(f"{key} — {title}" for key, title in ROOMS.items())
+            await update.message.reply_text(f"[BOT] Нет такой комнаты. Есть: {names}.")
+            return
+        await update.message.reply_text(await switch_room(context.application, user_id, room))
+        return
 
-    for uid, data in users_in_chat.items():
-        diff_sec = (now - data["last_activity"]).total_seconds()
-        moon = get_moon_symbol(diff_sec)
-        role = get_user_role(uid)
-        code = data["code"]
-        nick = data["nickname"]
-        line = f"{moon} {role} {code} {nick}"
-        lines.append(line)
-
-    msg = f"[BOT] В чате {len(users_in_chat)} (из {total_possible}):\n" + "\n".join(lines)
-    await update.message.reply_text(msg)
-    update_last_activity(update.effective_user.id)
+    current = room_of(user_id)
+    await update.message.reply_text(
+        f"[BOT] Ты в комнате «{ROOMS[current]}». Выбери комнату:",
+        reply_markup=build_rooms_keyboard(current)
+    )
+    update_last_activity(user_id)
+
+async def room_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    parts = query.data.split("|")
+    if len(parts) != 2 or parts[1] not in ROOMS:
+        await query.answer("Ошибка.")
+        return
+    if user_id not in users_in_chat:
+        await query.answer("Тебя нет в чате.")
+        return
+
+    text = await switch_room(context.application, user_id, parts[1])
+    try:
+        await query.message.edit_text(text)
+    except BadRequest:
+        pass
+    await query.answer()
 
 
 # ------------------------------------------------------------------------
@@ -337,12 +2754,14 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/stop - Выйти из чата\n"
         "/nick - Сменить ник\n"
         "/list - Список пользователей\n"
-        "/msg - Отправить личное сообщение\n"
+        "/last - Недавние сообщения комнаты\n"
+        "/room - Сменить комнату\n"
+        "/msg [НИК] - Отправить личное сообщение\n"
         "/getmsg - Получить личные сообщения\n"
-        "/hug [CODE] - Обнять пользователя\n"
+        "/hug [CODE|НИК] - Обнять пользователя\n"
         "/search [ТЕКСТ] - Поиск пользователя по нику\n"
         "/poll - Создать опрос\n"
-        "/polldone - Завершить опрос\n"
+        "/polldone [НОМЕР] - Завершить опрос (без номера — все свои)\n"
         "/notify - Настройки уведомлений\n"
         "/ping - Проверить бота\n"
         "/rules - Правила чата\n"
@@ -380,11 +2799,196 @@ async def ping(update: Update, context: ContextTypes.DEFAULT_TYPE):
     update_last_activity(update.effective_user.id)
 
 
+# ------------------------------------------------------------------------
+# 9.1) ВЫБОР ПОЛУЧАТЕЛЯ для /msg и /hug
+# ------------------------------------------------------------------------
+PICKER_PAGE_SIZE = 24   # кнопок на странице, по 3 в ряд (лимит Telegram — 100)
+PICKER_SEARCHES = 256   # результатов поиска, которые можно листать
+
+
+class RecipientPicker:
+    """
+    Постраничный выбор получателя. Кнопка пользователя строится один раз,
+    состав комнаты — снимок-список; и то и другое сбрасывается при
+    входе/выходе/смене ника или комнаты (roster_changed). Страница
+    собирается за O(PICKER_PAGE_SIZE), а не O(пользователей).
+
+    callback_data: "<select>|uid" — выбор, "<page>|N" или "<page>|N|sid" —
+    листание; sid — номер сохранённого результата поиска (/msg ник).
+    """
+
+    def __init__(self, select_prefix: str, page_prefix: str, cancel_data: str):
+        self.select_prefix = select_prefix
+        self.page_prefix = page_prefix
+        self.cancel_data = cancel_data
+        self.buttons = {}    # { uid: InlineKeyboardButton }
+        self.rosters = {}    # { room: [uid, ...] } в порядке входа
+        self.searches = collections.OrderedDict()   # { sid: [uid, ...] }
+        self.last_sid = 0
+
+    def invalidate(self, user_id: int = None):
+        if user_id is not None:
+            self.buttons.pop(user_id, None)
+        self.rosters.clear()
+
+    def _roster(self, room: str) -> list:
+        roster = self.rosters.get(room)
+        if roster is None:
+            roster = self.rosters[room] = list(room_members[room])
+        return roster
+
+    def _button(self, uid: int):
+        button = self.buttons.get(uid)
+        if button is None:
+            data = users_in_chat[uid]
+            button = self.buttons[uid] = InlineKeyboardButton(
+                f"{data['code']} {data['nickname']}", callback_data=f"{self.select_prefix}|{uid}"
+            )
+        return button
+
+    def search(self, room: str, viewer: int, query: str) -> int:
+        """Сохранить найденных в комнате (кроме viewer) по коду (#ABCD) или части ника. Вернёт sid или 0."""
+        if query.startswith("#"):
+            found = [uid for uid in (get_user_by_code(query),) if uid is not None]
+        else:
+            found = user_registry.search(query)
+        uids = sorted((uid for uid in found if uid != viewer and room_of(uid) == room), key=lambda u: users_in_chat[u]["nickname"])
+        if not uids:
+            return 0
+        self.last_sid += 1
+        self.searches[self.last_sid] = uids
+        if len(self.searches) > PICKER_SEARCHES:
+            self.searches.popitem(last=False)
+        return self.last_sid
+
+    def markup(self, room: str, viewer: int, page: int = 0, sid: int = 0):
+        """Клавиатура страницы; None — выбирать некого (или результат поиска устарел)."""
+        uids = self.searches.get(sid) if sid else self._roster(room)
+        if not uids or (not sid and len(uids) == 1 and uids[0] == viewer):
+            return None
+        pages = (len(uids) + PICKER_PAGE_SIZE - 1) // PICKER_PAGE_SIZE
+        page = max(0, min(page, pages - 1))
+        start = page * PICKER_PAGE_SIZE
+        buttons = [
+            self._button(uid) for uid in uids[start:start + PICKER_PAGE_SIZE]
+            if uid != viewer and uid in users_in_chat
+        ]
+        kb = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+        if pages > 1:
+            suffix = f"|{sid}" if sid else ""
+            nav = []
+            if page > 0:
+                nav.append(InlineKeyboardButton("◀️", callback_data=f"{self.page_prefix}|{page - 1}{suffix}"))
+            nav.append(InlineKeyboardButton(f"{page + 1}/{pages}", callback_data=f"{self.page_prefix}|{page}{suffix}"))
+            if page < pages - 1:
+                nav.append(InlineKeyboardButton("▶️", callback_data=f"{self.page_prefix}|{page + 1}{suffix}"))
+            kb.append(nav)
+        kb.append([InlineKeyboardButton("❌ Отмена", callback_data=self.cancel_data)])
+        return InlineKeyboardMarkup(kb)
+
+    def open(self, viewer: int, query: str = ""):
+        """Первая страница пикера для viewer, с поиском, если задан query."""
+        room = room_of(viewer)
+        sid = self.search(room, viewer, query) if query else 0
+        if query and not sid:
+            return None
+        return self.markup(room, viewer, 0, sid)
+
+    async def page_callback(self, update: Update) -> bool:
+        """Листание: перерисовать клавиатуру. False — данные кнопки устарели."""
+        query = update.callback_query
+        user_id = update.effective_user.id
+        parts = query.data.split("|")
+        if user_id not in users_in_chat or len(parts) not in (2, 3) or not all(p.isdigit() for p in parts[1:]):
+            await query.answer("Ошибка.")
+            return False
+        sid = int(parts[2]) if len(parts) == 3 else 0
+        markup = self.markup(room_of(user_id), user_id, int(parts[1]), sid)
+        if markup is None:
+            await query.answer("Список устарел, вызови команду заново.")
+            return False
+        try:
+            await query.message.edit_reply_markup(reply_markup=markup)
+        except BadRequest:
+            pass  # страница не изменилась
+        await query.answer()
+        return True
+
+
+msg_picker = RecipientPicker("msg_select", "msgp", "msg_cancel")
+hug_picker = RecipientPicker("hug_select", "hugp", "hug_cancel")
+
+
 # ------------------------------------------------------------------------
 # 10) ЛИЧНЫЕ СООБЩЕНИЯ /msg
 # ------------------------------------------------------------------------
 MSG_SELECT_RECIPIENT, MSG_ENTER_TEXT = range(2)
+INBOX_CAP = int(os.getenv("INBOX_CAP", "200"))                   # сообщений на пользователя
+INBOX_TTL = float(os.getenv("INBOX_TTL_DAYS", "30")) * 86400     # сек; старше — выбрасываем
+GETMSG_PAGE_SIZE = 10
+GETMSG_PREVIEW = 300   # символов сообщения в списке /getmsg
+
+
+class PrivateMessage:
+    __slots__ = ("sender", "text", "at", "read")
+
+    def __init__(self, sender: str, text: str, at: float, read: bool = False):
+        self.sender = sender
+        self.text = text
+        self.at = at
+        self.read = read
+
+
+class Inbox:
+    """
+    Личные сообщения пользователя: кольцевой буфер на INBOX_CAP записей
+    с выбрасыванием старше INBOX_TTL и учётом непрочитанных.
+    """
+    __slots__ = ("messages", "unread")
+
+    def __init__(self, messages=()):
+        self.messages = collections.deque(messages, maxlen=INBOX_CAP)
+        self.unread = sum(not m.read for m in self.messages) if messages else 0
+
+    def __len__(self):
+        return len(self.messages)
+
+    def add(self, sender: str, text: str):
+        if len(self.messages) == self.messages.maxlen and not self.messages[0].read:
+            self.unread -= 1
+        self.messages.append(PrivateMessage(sender, text, time.time()))
+        self.unread += 1
+        self.expire()
+
+    def expire(self):
+        cutoff = time.time() - INBOX_TTL
+        while self.messages and self.messages[0].at < cutoff:
+            if not self.messages.popleft().read:
+                self.unread -= 1
+
+    def page(self, offset: int, size: int) -> list:
+        """Сообщения от новых к старым, начиная с offset."""
+        n = len(self.messages)
+        return [self.messages[n - 1 - i] for i in range(offset, min(offset + size, n))]
+
+    def mark_read(self, messages: list):
+        for m in messages:
+            if not m.read:
+                m.read = True
+                self.unread -= 1
+
+    def to_state(self) -> list:
+        return [[m.sender, m.text, m.at, m.read] for m in self.messages]
+
+    @classmethod
+    def from_state(cls, rows: list):
+        return cls([PrivateMessage(*row) for row in rows])
 
+
+state_store.register("private_messages", private_messages, encode=Inbox.to_state, decode=Inbox.from_state)
+
+
+@flood_guard.limit("msg")
 async def msg_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in users_in_chat:
@@ -400,46 +3004,44 @@ async def msg_command_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("[BOT] Не нашли пользователя с таким кодом.")
             return ConversationHandler.END
 
+        # Как и /hug: ЛС — только собеседникам из своей комнаты
+        if room_of(to_user) != room_of(user_id):
+            await update.message.reply_text("[BOT] Этот пользователь в другой комнате.")
+            return ConversationHandler.END
+
         from_nick = users_in_chat[user_id]["nickname"]
         ensure_user_in_dicts(to_user)
         # Сохраняем копию
-        private_messages[to_user].append({"from": from_nick, "text": text_msg})
+        private_messages[to_user].add(from_nick, text_msg)
+        state_store.mark("private_messages", to_user)
 
-        # Отправляем получателю сразу
-        chat_to = users_in_chat[to_user]["chat_id"]
-        await context.application.bot.send_message(
-            chat_id=chat_to,
-            text=f"[ЛС от {from_nick}]: {text_msg}"
-        )
+        # Отправляем получателю через очередь (или в дайджест, см. /notify)
+        deliver_text(to_user, f"[ЛС от {from_nick}]: {text_msg}", "private")
 
         await update.message.reply_text(f"[BOT] Личное сообщение отправлено для {code}.")
         update_last_activity(user_id)
         return ConversationHandler.END
 
-    # иначе — показать inline-список (кнопочки) всех
-    keyboard = []
-    row = []
-    i = 0
-    for uid, data in users_in_chat.items():
-        if uid == user_id:
-            continue
-        i += 1
-        btn_text = f"{data['code']} {data['nickname']}"
-        row.append(InlineKeyboardButton(btn_text, callback_data=f"msg_select|{uid}"))
-        if i % 3 == 0:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-
-    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="msg_cancel")])
+    # иначе — постраничный список комнаты; /msg ник — только найденные
+    query = context.args[0] if context.args else ""
+    markup = msg_picker.open(user_id, query)
+    if markup is None:
+        await update.message.reply_text(
+            "[BOT] Никого не нашли." if query else "[BOT] В комнате больше никого нет."
+        )
+        return ConversationHandler.END
     await update.message.reply_text(
         "[BOT] Выбери пользователя, чтобы отправить ЛС:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=markup
     )
     update_last_activity(user_id)
     return MSG_SELECT_RECIPIENT
 
+async def msg_picker_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await msg_picker.page_callback(update):
+        return ConversationHandler.END
+    return MSG_SELECT_RECIPIENT
+
 async def msg_callback_select_recipient(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = update.effective_user.id
@@ -449,6 +3051,12 @@ async def msg_callback_select_recipient(update: Update, context: ContextTypes.DE
         return ConversationHandler.END
 
     recipient_id = int(parts[1])
+    if recipient_id not in users_in_chat:
+        await query.answer("Пользователь уже вышел.")
+        return MSG_SELECT_RECIPIENT
+    if user_id not in users_in_chat or room_of(recipient_id) != room_of(user_id):
+        await query.answer("Этот пользователь в другой комнате.")
+        return MSG_SELECT_RECIPIENT
     context.user_data["msg_recipient"] = recipient_id
 
     code_to = users_in_chat[recipient_id]["code"]
@@ -470,6 +3078,9 @@ async def msg_enter_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if recipient_id not in users_in_chat:
         await update.message.reply_text("[BOT] Похоже, пользователь вышел.")
         return ConversationHandler.END
+    if user_id not in users_in_chat or room_of(recipient_id) != room_of(user_id):
+        await update.message.reply_text("[BOT] Этот пользователь уже в другой комнате.")
+        return ConversationHandler.END
 
     from_nick = users_in_chat[user_id]["nickname"]
     text_msg = update.message.text
@@ -479,14 +3090,11 @@ async def msg_enter_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     ensure_user_in_dicts(recipient_id)
     # Сохраняем копию
-    private_messages[recipient_id].append({"from": from_nick, "text": text_msg})
+    private_messages[recipient_id].add(from_nick, text_msg)
+    state_store.mark("private_messages", recipient_id)
 
-    # Отправляем получателю
-    chat_to = users_in_chat[recipient_id]["chat_id"]
-    await context.application.bot.send_message(
-        chat_id=chat_to,
-        text=f"[ЛС от {from_nick}]: {text_msg}"
-    )
+    # Отправляем получателю через очередь (или в дайджест, см. /notify)
+    deliver_text(recipient_id, f"[ЛС от {from_nick}]: {text_msg}", "private")
 
     await update.message.reply_text(
         f"[BOT] Сообщение для {to_code} {to_nick} отправлено."
@@ -503,6 +3111,32 @@ async def msg_callback_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE
     await query.answer()
     return ConversationHandler.END
 
+def render_inbox_page(user_id: int, offset: int):
+    """Страница /getmsg (от новых к старым) и клавиатура навигации."""
+    inbox = private_messages[user_id]
+    inbox.expire()
+    offset = max(0, min(offset, max(len(inbox) - 1, 0)))
+    unread_before = inbox.unread
+    messages = inbox.page(offset, GETMSG_PAGE_SIZE)
+    lines = []
+    for m in messages:
+        text = m.text if len(m.text) <= GETMSG_PREVIEW else m.text[:GETMSG_PREVIEW] + "…"
+        mark = "🆕 " if not m.read else ""
+        lines.append(f"{mark}От {m.sender}: {text}")
+    inbox.mark_read(messages)
+    state_store.mark("private_messages", user_id)
+    header = f"[BOT] Твои личные сообщения (копия), всего {len(inbox)}"
+    if unread_before:
+        header += f", новых {unread_before}"
+    text = header + ":\n\n" + "\n".join(lines)
+
+    nav = []
+    if offset > 0:
+        nav.append(InlineKeyboardButton("◀️ Новее", callback_data=f"getmsg|{max(0, offset - GETMSG_PAGE_SIZE)}"))
+    if offset + GETMSG_PAGE_SIZE < len(inbox):
+        nav.append(InlineKeyboardButton("Старее ▶️", callback_data=f"getmsg|{offset + GETMSG_PAGE_SIZE}"))
+    return text, InlineKeyboardMarkup([nav]) if nav else None
+
 async def getmsg_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in users_in_chat:
@@ -510,16 +3144,34 @@ async def getmsg_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     ensure_user_in_dicts(user_id)
-    msgs = private_messages[user_id]
-    if not msgs:
+    private_messages[user_id].expire()
+    if not private_messages[user_id]:
         await update.message.reply_text("[BOT] У тебя нет личных сообщений.")
         return
 
-    lines = []
-    for m in msgs:
-        lines.append(f"От {m['from']}: {m['text']}")
-    text = "[BOT] Твои личные сообщения (копия):\n\n" + "\n".join(lines)
-    await update.message.reply_text(text)
+    text, kb = render_inbox_page(user_id, 0)
+    await update.message.reply_text(text, reply_markup=kb)
+    update_last_activity(user_id)
+
+async def getmsg_page_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    parts = query.data.split("|")
+    if len(parts) != 2 or not parts[1].isdigit():
+        await query.answer("Ошибка.")
+        return
+
+    ensure_user_in_dicts(user_id)
+    if not private_messages[user_id]:
+        await query.answer("У тебя нет личных сообщений.")
+        return
+
+    text, kb = render_inbox_page(user_id, int(parts[1]))
+    try:
+        await query.message.edit_text(text, reply_markup=kb)
+    except BadRequest:
+        pass
+    await query.answer()
     update_last_activity(user_id)
 
 
@@ -528,6 +3180,7 @@ async def getmsg_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------------------------------------------------------------
 HUG_SELECT = range(1)
 
+@flood_guard.limit("hug")
 async def hug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in users_in_chat:
@@ -535,45 +3188,45 @@ async def hug_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return ConversationHandler.END
 
     # Если /hug CODE
-    if context.args:
+    if context.args and context.args[0].startswith("#"):
         code = context.args[0]
         to_user = get_user_by_code(code)
         if not to_user:
             await update.message.reply_text("[BOT] Не нашли пользователя с таким кодом.")
             return ConversationHandler.END
 
+        if room_of(to_user) != room_of(user_id):
+            await update.message.reply_text("[BOT] Этот пользователь в другой комнате.")
+            return ConversationHandler.END
+
         from_nick = users_in_chat[user_id]["nickname"]
         from_code = users_in_chat[user_id]["code"]
         to_nick = users_in_chat[to_user]["nickname"]
         text = f"[Bot] {from_code} {from_nick} обнял(а) {to_nick}!"
-        await broadcast_text(context.application, text)
+        await broadcast_text(context.application, text, kinds={to_user: "hug"}, room=room_of(user_id))
         update_last_activity(user_id)
         return ConversationHandler.END
 
-    # Иначе inline-список
-    keyboard = []
-    row = []
-    i = 0
-    for uid, data in users_in_chat.items():
-        if uid == user_id:
-            continue
-        i += 1
-        btn_text = f"{data['code']} {data['nickname']}"
-        row.append(InlineKeyboardButton(btn_text, callback_data=f"hug_select|{uid}"))
-        if i % 3 == 0:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-
-    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data="hug_cancel")])
+    # Иначе постраничный список комнаты; /hug ник — только найденные
+    query = context.args[0] if context.args else ""
+    markup = hug_picker.open(user_id, query)
+    if markup is None:
+        await update.message.reply_text(
+            "[BOT] Никого не нашли." if query else "[BOT] В комнате больше никого нет."
+        )
+        return ConversationHandler.END
     await update.message.reply_text(
         "[BOT] Выбери, кого обнять:",
-        reply_markup=InlineKeyboardMarkup(keyboard)
+        reply_markup=markup
     )
     update_last_activity(user_id)
     return HUG_SELECT
 
+async def hug_picker_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await hug_picker.page_callback(update):
+        return ConversationHandler.END
+    return HUG_SELECT
+
 async def hug_select_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     user_id = update.effective_user.id
@@ -583,12 +3236,18 @@ async def hug_select_callback(update: Update, context: ContextTypes.DEFAULT_TYPE
         return ConversationHandler.END
 
     to_user_id = int(parts[1])
+    if user_id not in users_in_chat or to_user_id not in users_in_chat:
+        await query.answer("Пользователь уже вышел.")
+        return HUG_SELECT
+    if room_of(to_user_id) != room_of(user_id):
+        await query.answer("Этот пользователь в другой комнате.")
+        return HUG_SELECT
     from_nick = users_in_chat[user_id]["nickname"]
     from_code = users_in_chat[user_id]["code"]
     to_nick = users_in_chat[to_user_id]["nickname"]
 
     text = f"[Bot] {from_code} {from_nick} обнял(а) {to_nick}!"
-    await broadcast_text(context.application, text)
+    await broadcast_text(context.application, text, kinds={to_user_id: "hug"}, room=room_of(user_id))
     await query.message.edit_text("Обнимашка отправлена!")
     await query.answer()
     update_last_activity(user_id)
@@ -614,11 +3273,11 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("[BOT] /search <текст> — поиск в нике.")
         return
 
-    pattern = " ".join(context.args).lower()
+    pattern = " ".join(context.args)
     results = []
-    for uid, info in users_in_chat.items():
-        if pattern in info["nickname"].lower():
-            results.append(f"{info['code']} {info['nickname']}")
+    for uid in user_registry.search(pattern):
+        info = users_in_chat[uid]
+        results.append(f"{info['code']} {info['nickname']}")
 
     if results:
         await update.message.reply_text("[BOT] Найдены:\n" + "\n".join(results))
@@ -631,12 +3290,248 @@ async def search_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # 13) /poll
 # ------------------------------------------------------------------------
 POLL_AWAITING_QUESTION = range(1)
+POLL_EDIT_DELAY = float(os.getenv("POLL_EDIT_DELAY", "1.5"))  # окно склейки голосов, сек
+POLL_TTL = float(os.getenv("POLL_TTL_HOURS", "24")) * 3600   # опрос закрывается сам; 0 — не закрывать
+POLL_MAX_ACTIVE = 5                                          # открытых опросов на автора
+
+
+class Poll:
+    """
+    Опрос. Голоса — карта { uid: вариант } и счётчики по вариантам, поэтому
+    переголосование — O(1). Копии у получателей хранятся массивами:
+    chat_ids / message_ids / shown (версия текста, показанная получателю) /
+    queued (версия, правка с которой ещё в очереди; 0 — нет), а не словарями
+    на каждого — опрос на 10 000 человек занимает ~320 КБ.
+    """
+    __slots__ = ("id", "room", "creator", "question", "options", "counts", "choices",
+                 "expires", "version", "chat_ids", "message_ids", "shown", "queued")
+
+    def __init__(self, poll_id: int, room: str, creator: int, question: str, options: list,
+                 expires: float = 0.0):
+        self.id = poll_id
+        self.room = room
+        self.creator = creator
+        self.question = question
+        self.options = options
+        self.counts = [0] * len(options)
+        self.choices = {}   # { uid: индекс варианта }
+        self.expires = expires
+        self.version = 0    # растёт с каждым голосом
+        self.chat_ids = array.array("q")
+        self.message_ids = array.array("q")
+        self.shown = array.array("q")
+        self.queued = array.array("q")
+
+    def add_copy(self, chat_id: int, message_id: int):
+        self.chat_ids.append(chat_id)
+        self.message_ids.append(message_id)
+        self.shown.append(0)
+        self.queued.append(0)
+
+    def vote(self, user_id: int, index: int) -> bool:
+        """Засчитать голос. False — пользователь уже голосовал за этот вариант."""
+        previous = self.choices.get(user_id)
+        if previous == index:
+            return False
+        if previous is not None:
+            self.counts[previous] -= 1
+        self.counts[index] += 1
+        self.choices[user_id] = index
+        self.version += 1
+        return True
+
+    def to_state(self) -> dict:
+        return {
+            "id": self.id, "room": self.room, "creator": self.creator,
+            "question": self.question, "options": self.options,
+            "choices": self.choices, "expires": self.expires,
+            "chat_ids": self.chat_ids.tolist(), "message_ids": self.message_ids.tolist(),
+        }
+
+    @classmethod
+    def from_state(cls, data: dict):
+        poll = cls(data["id"], data["room"], data["creator"], data["question"], data["options"],
+                   data["expires"])
+        for uid, index in data["choices"].items():
+            poll.vote(uid, index)
+        poll.chat_ids.extend(data["chat_ids"])
+        poll.message_ids.extend(data["message_ids"])
+        poll.shown.extend([-1] * len(poll.chat_ids))   # после рестарта перерисуем при первом голосе
+        poll.queued.extend([0] * len(poll.chat_ids))
+        return poll
+
+
+class PollEngine:
+    """
+    Все открытые опросы по глобальному id: у автора их может быть несколько.
+    Закрытые удаляются. Истечение — куча (expires, id) и один таймер на ближайший.
+    Номер последнего опроса — в bot_meta, чтобы id не повторялись после рестарта.
+    """
+
+    def __init__(self):
+        self.by_creator = {}   # { creator: [poll_id, ...] } — открытые, в порядке создания
+        self.due = []          # куча (expires, poll_id)
+        self.handle = None
+
+    def index(self, poll: Poll):
+        self.by_creator.setdefault(poll.creator, []).append(poll.id)
+        if poll.expires:
+            heapq.heappush(self.due, (poll.expires, poll.id))
+
+    @staticmethod
+    def new_poll(room: str, creator: int, question: str, options: list) -> Poll:
+        poll_id = bot_meta.get("last_poll_id", 0) + 1
+        bot_meta["last_poll_id"] = poll_id
+        state_store.mark("bot_meta", "last_poll_id")
+        poll = polls[poll_id] = Poll(poll_id, room, creator, question, options,
+                                     time.time() + POLL_TTL if POLL_TTL else 0.0)
+        state_store.mark("poll_by_id", poll_id)
+        return poll
+
+    def create(self, room: str, creator: int, question: str, options: list) -> Poll:
+        poll = self.new_poll(room, creator, question, options)
+        self.index(poll)
+        self.arm()
+        return poll
+
+    def active_of(self, creator: int) -> list:
+        return [polls[poll_id] for poll_id in self.by_creator.get(creator, ())]
+
+    def close(self, poll: Poll):
+        """Закрыть: итоговый текст без кнопок у всех получателей, опрос — из памяти и хранилища."""
+        polls.pop(poll.id, None)
+        ids = self.by_creator.get(poll.creator, [])
+        if poll.id in ids:
+            ids.remove(poll.id)
+        if not ids:
+            self.by_creator.pop(poll.creator, None)
+        state_store.mark("poll_by_id", poll.id)
+        poll_edits.forget(poll.id)
+        text = "🔒 Опрос завершён\n" + render_poll_text(poll)
+        for chat_id, message_id in zip(poll.chat_ids, poll.message_ids):
+            outbox.enqueue(chat_id, "edit_message_text", label=f"опрос #{poll.id} -> {chat_id}",
+                           priority=PRIORITY_BULK, message_id=message_id, text=text)
+
+    def arm(self):
+        """Таймер на ближайшее истечение (после restore_state — из post_init)."""
+        if not self.due:
+            return
+        if self.handle is not None:
+            self.handle.cancel()
+        delay = max(0.0, self.due[0][0] - time.time())
+        self.handle = asyncio.get_running_loop().call_later(delay, self.expire)
+
+    def expire(self):
+        self.handle = None
+        now = time.time()
+        while self.due and self.due[0][0] <= now:
+            _, poll_id = heapq.heappop(self.due)
+            poll = polls.get(poll_id)
+            if poll is not None:
+                self.close(poll)
+        self.arm()
+
+
+poll_engine = PollEngine()
+state_store.register("poll_by_id", polls, encode=Poll.to_state, decode=Poll.from_state)
+
+
+def build_poll_keyboard(poll_id: int, options: list):
+    kb = []
+    for i, opt in enumerate(options, start=1):
+        callback_data = f"pv|{poll_id}|{i}"
+        btn_text = f"{i} - {opt}"
+        kb.append([InlineKeyboardButton(btn_text, callback_data=callback_data)])
+    return InlineKeyboardMarkup(kb)
+
+def render_poll_text(poll: Poll) -> str:
+    """Текст опроса с результатами по счётчикам."""
+    out_lines = [f"#{poll.id} {poll.question}"]
+    for i, (opt, c) in enumerate(zip(poll.options, poll.counts), start=1):
+        mark = "✔️" if c > 0 else f"{i}"
+        out_lines.append(f"{mark} - {opt} ({c})")
+    return "\n".join(out_lines)
+
+
+class PollEditCoalescer:
+    """
+    Склейка правок опросов: голоса за окно POLL_EDIT_DELAY дают один проход
+    edit_message_text через очередь отправки. Получателей, у которых уже
+    показана текущая версия опроса, пропускаем, как и тех, чья прошлая правка
+    ещё в очереди: когда она уйдёт, опрос снова помечается и следующий проход
+    дошлёт свежую версию. Так на копию в очереди не больше одной правки.
+    """
 
+    def __init__(self, delay: float):
+        self.delay = delay
+        self.dirty = set()   # { poll_id }
+        self.handle = None
+
+    def touch(self, poll_id: int):
+        self.dirty.add(poll_id)
+        if self.handle is None:
+            self.handle = asyncio.get_running_loop().call_later(self.delay, self.flush)
+
+    def forget(self, poll_id: int):
+        self.dirty.discard(poll_id)
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()   # вызвали досрочно (остановка бота)
+            self.handle = None
+        dirty, self.dirty = self.dirty, set()
+        for poll_id in dirty:
+            poll = polls.get(poll_id)
+            if poll is None:
+                continue
+            text = render_poll_text(poll)
+            markup = build_poll_keyboard(poll.id, poll.options).to_dict()
+            version = poll.version
+            for i, shown in enumerate(poll.shown):
+                if shown == version or poll.queued[i]:
+                    continue
+                poll.queued[i] = version
+                done = self._done(poll, i, version)
+                outbox.enqueue(
+                    poll.chat_ids[i],
+                    "edit_message_text",
+                    label=f"опрос #{poll.id} -> {poll.chat_ids[i]}",
+                    on_sent=done,
+                    on_failed=done,
+                    priority=PRIORITY_BULK,
+                    message_id=poll.message_ids[i],
+                    text=text,
+                    reply_markup=markup
+                )
+
+    def _done(self, poll: Poll, i: int, version: int):
+        """
+        Правка ушла или снята с ошибкой: копия свободна. Неудачную версию
+        считаем показанной — повторим со следующим голосом, а не по кругу.
+        """
+        def done(_msg=None):
+            poll.queued[i] = 0
+            if poll.shown[i] < version:
+                poll.shown[i] = version
+            if poll.version > version and poll.id in polls:
+                self.touch(poll.id)
+        return done
+
+
+poll_edits = PollEditCoalescer(POLL_EDIT_DELAY)
+
+
+@flood_guard.limit("poll")
 async def poll_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in users_in_chat:
         await update.message.reply_text("[BOT] Тебя нет в чате.")
         return ConversationHandler.END
+    if len(poll_engine.active_of(user_id)) >= POLL_MAX_ACTIVE:
+        await update.message.reply_text(
+            f"[BOT] У тебя уже {POLL_MAX_ACTIVE} открытых опросов. Заверши какой-нибудь: /polldone НОМЕР."
+        )
+        return ConversationHandler.END
 
     await update.message.reply_text(
         "[BOT] Начинаем опрос.\n\n"
@@ -655,132 +3550,104 @@ async def poll_received_text(update: Update, context: ContextTypes.DEFAULT_TYPE)
         return ConversationHandler.END
 
     text = update.message.text.strip()
-    lines = text.split("\n")
-    if len(lines) < 2:
+    if "\n" not in text:
         await update.message.reply_text("[BOT] Нужно минимум 1 вопрос и 1 вариант ответа.")
         return ConversationHandler.END
 
+    # Вопрос и варианты уходят всей комнате — фильтр триггеров, как у сообщений.
+    # Маска не трогает переводы строк, так что строки делим уже после неё.
+    text, verdict = await screen_text(update, user_id, text)
+    if verdict and verdict.action == "hold":
+        await hold_message(update, user_id, verdict, poll=text)
+        return ConversationHandler.END
+
+    publish_poll(user_id, room_of(user_id), text)
+    update_last_activity(user_id)
+    return ConversationHandler.END
+
+def publish_poll(user_id: int, room: str, text: str) -> Poll:
+    """Создать опрос (вопрос и варианты — по строкам) и разослать комнате (из /poll и после модерации)."""
+    lines = text.split("\n")
     question = lines[0]
     options = lines[1:]
-
-    polls[user_id] = {
-        "question": question,
-        "options": options,
-        "votes": {opt: set() for opt in options},
-        "active": True,
-        "message_ids": {},
-        "chat_ids": {}
-    }
+    poll = poll_engine.create(room, user_id, question, options)
 
     from_nick = users_in_chat[user_id]["nickname"]
     from_code = users_in_chat[user_id]["code"]
-    header_text = f"[Bot] {from_code} {from_nick} поставил(а) вопрос:\n{question}"
-
-    def build_poll_keyboard(creator_id):
-        kb = []
-        for i, opt in enumerate(options, start=1):
-            callback_data = f"pollvote|{creator_id}|{i}"
-            btn_text = f"{i} - {opt}"
-            kb.append([InlineKeyboardButton(btn_text, callback_data=callback_data)])
-        return InlineKeyboardMarkup(kb)
-
-    markup = build_poll_keyboard(user_id)
-    for uid, info in users_in_chat.items():
-        try:
-            msg = await context.application.bot.send_message(
-                chat_id=info["chat_id"],
-                text=header_text,
-                reply_markup=markup
-            )
-            polls[user_id]["message_ids"][uid] = msg.message_id
-            polls[user_id]["chat_ids"][uid] = info["chat_id"]
-        except Exception as e:
-            logging.warning(f"Не смог отправить опрос {info['nickname']}: {e}")
-
-    update_last_activity(user_id)
-    return ConversationHandler.END
+    header_text = f"[Bot] {from_code} {from_nick} поставил(а) вопрос #{poll.id}:\n{question}"
+    markup = build_poll_keyboard(poll.id, options)
+
+    def remember_message(chat_id):
+        def on_sent(msg):
+            if poll.id in polls:
+                poll.add_copy(chat_id, msg.message_id)
+                state_store.mark("poll_by_id", poll.id)
+        return on_sent
+
+    for uid in by_activity(room_members[room]):
+        info = users_in_chat[uid]
+        outbox.enqueue(
+            info["chat_id"],
+            "send_message",
+            label=info["nickname"],
+            on_sent=remember_message(info["chat_id"]),
+            priority=PRIORITY_CHAT,
+            text=header_text,
+            reply_markup=markup
+        )
+    return poll
 
 async def poll_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("[BOT] Опрос отменён.")
     return ConversationHandler.END
 
 async def poll_done(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/polldone — закрыть все свои опросы, /polldone N — только опрос #N."""
     user_id = update.effective_user.id
-    if user_id not in polls or not polls[user_id]["active"]:
-        await update.message.reply_text("[BOT] У тебя нет активных опросов.")
+    # Опрос мог остаться в комнате, из которой пользователь уже ушёл — ищем по автору
+    mine = poll_engine.active_of(user_id)
+    if context.args:
+        number = context.args[0].lstrip("#")
+        mine = [poll for poll in mine if str(poll.id) == number]
+    if not mine:
+        await update.message.reply_text("[BOT] У тебя нет таких открытых опросов.")
         return
 
-    polls[user_id]["active"] = False
-    await update.message.reply_text("[BOT] Твой опрос завершён.")
-
-    # Уберём кнопки у всех
-    for uid, msg_id in polls[user_id]["message_ids"].items():
-        chat_id = polls[user_id]["chat_ids"][uid]
-        try:
-            await context.application.bot.edit_message_reply_markup(
-                chat_id=chat_id,
-                message_id=msg_id,
-                reply_markup=None
-            )
-        except:
-            pass
+    for poll in mine:
+        poll_engine.close(poll)
+    numbers = ", ".join(f"#{poll.id}" for poll in mine)
+    await update.message.reply_text(f"[BOT] Опрос завершён: {numbers}.")
 
     update_last_activity(user_id)
 
 async def poll_vote_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     parts = query.data.split("|")
-    if len(parts) != 3 or parts[0] != "pollvote":
+    # Кнопки pollvote|автор|i — опросы до движка: они не сохранялись и давно закрыты.
+    # Искать «последний опрос автора» нельзя — голос ушёл бы в чужой, новый опрос.
+    if parts[0] == "pollvote":
+        await query.answer("Опрос не найден или уже завершён.")
+        return
+    if len(parts) != 3 or not parts[1].isdigit() or not parts[2].isdigit():
         await query.answer("Ошибка.")
         return
 
-    creator_id = int(parts[1])
-    opt_index = int(parts[2]) - 1
+    poll = polls.get(int(parts[1]))
+    opt_index = int(parts[-1]) - 1
     user_id = update.effective_user.id
 
-    if creator_id not in polls:
-        await query.answer("Опрос не найден или не активен.")
+    if poll is None:
+        await query.answer("Опрос не найден или уже завершён.")
         return
-    poll_data = polls[creator_id]
-    if not poll_data["active"]:
-        await query.answer("Опрос завершён.")
-        return
-
-    options = poll_data["options"]
-    if opt_index < 0 or opt_index >= len(options):
+    if opt_index < 0 or opt_index >= len(poll.options):
         await query.answer("Неправильный вариант.")
         return
 
-    chosen_opt = options[opt_index]
-    # Снимаем предыдущие голоса
-    for opt in options:
-        if user_id in poll_data["votes"][opt]:
-            poll_data["votes"][opt].remove(user_id)
-    poll_data["votes"][chosen_opt].add(user_id)
+    if poll.vote(user_id, opt_index):
+        state_store.mark("poll_by_id", poll.id)
+        # Результаты у всех обновятся одним проходом после окна склейки
+        poll_edits.touch(poll.id)
     await query.answer("Голос учтён!")
-
-    # Пересобираем текст (результаты)
-    question = poll_data["question"]
-    out_lines = [question]
-    for i, opt in enumerate(options, start=1):
-        c = len(poll_data["votes"][opt])
-        mark = "✔️" if c > 0 else f"{i}"
-        out_lines.append(f"{mark} - {opt} ({c})")
-
-    new_text = "\n".join(out_lines)
-    # Обновим сообщение у всех
-    for uid, msg_id in poll_data["message_ids"].items():
-        chat_id = poll_data["chat_ids"][uid]
-        try:
-            await context.application.bot.edit_message_text(
-                chat_id=chat_id,
-                message_id=msg_id,
-                text=new_text,
-                reply_markup=query.message.reply_markup
-            )
-        except Exception as e:
-            logging.warning(f"Не смог обновить опрос для {uid}: {e}")
-
     update_last_activity(user_id)
 
 
@@ -815,7 +3682,12 @@ async def notify_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     ensure_user_in_dicts(user_id)
     kb = build_notify_keyboard(user_id)
-    await update.message.reply_text("[BOT] Настройки уведомлений:", reply_markup=kb)
+    await update.message.reply_text(
+        "[BOT] Настройки уведомлений:\n"
+        "Интервал N > 0 — сообщения чата приходят сводкой раз в N минут.\n"
+        "✅ у ЛС, ответов и обнимашек — такие приходят сразу, без сводки.",
+        reply_markup=kb
+    )
     update_last_activity(user_id)
 
 async def notify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -834,10 +3706,14 @@ async def notify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif len(parts) == 3 and parts[1] == "interval":
         val = int(parts[2])
         user_notify_settings[user_id]["interval"] = val
+        if val == 0:
+            digests.flush_user(user_id)
     else:
         await query.answer("Неизвестный параметр.")
         return
 
+    state_store.mark("user_notify_settings", user_id)
+
     new_kb = build_notify_keyboard(user_id)
     try:
         await query.message.edit_reply_markup(new_kb)
@@ -850,6 +3726,39 @@ async def notify_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
 # ------------------------------------------------------------------------
 # 15) ОБРАБОТКА СООБЩЕНИЙ (текст + фото)
 # ------------------------------------------------------------------------
+TRIGGER_NOTICES = {
+    "warn": "[BOT] Пожалуйста, бережнее: такие темы могут задеть других участников (см. /rules).",
+    "mask": "[BOT] Цифры, калории и вес в чате скрываются звёздочками (см. /rules).",
+}
+
+async def screen_text(update: Update, user_id: int, text: str):
+    """
+    Фильтр триггеров: (текст для рассылки, совпадение или None).
+    warn/mask — напоминаем автору о правилах, mask — прячем совпадения;
+    при hold текст не меняем — решает вызывающий (hold_message).
+    """
+    match = trigger_filter.check(text) if text else None
+    if match is None or match.action == "hold":
+        return text, match
+    if match.action == "mask":
+        text = mask_spans(text, match.spans)
+    if trigger_filter.should_notice(user_id):
+        await update.message.reply_text(TRIGGER_NOTICES[match.action])
+    return text, match
+
+async def hold_message(update: Update, user_id: int, match, **content):
+    """Не рассылать: отдать модераторам, а если их нет — просто не отправлять."""
+    wait = flood_guard.check(user_id, "hold")
+    if wait:
+        await flood_guard.warn(update, wait)
+        return
+    if admin_ids or moderator_ids:
+        held_messages.add(user_id, room_of(user_id), match.phrases, **content)
+        await update.message.reply_text("[BOT] Сообщение отправлено модераторам на проверку.")
+    else:
+        await update.message.reply_text("[BOT] Сообщение не отправлено: оно нарушает правила чата (/rules).")
+    logging.info(f"Сообщение {user_id} задержано фильтром: {', '.join(match.phrases)}")
+
 async def anonymous_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = update.effective_user.id
     if user_id not in users_in_chat:
@@ -857,27 +3766,53 @@ async def anonymous_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     nickname = users_in_chat[user_id]["nickname"]
-    code = users_in_chat[user_id]["code"]
-
-    # Если фото
-    if update.message.photo:
-        photo = update.message.photo[-1]
-        file_id = photo.file_id
-        caption = update.message.caption if update.message.caption else ""
-        full_caption = f"{code} {nickname} прислал(а) фото"
-        if caption:
-            full_caption += f"\n{caption}"
+    chat_id = update.effective_chat.id
 
-        await broadcast_photo(context.application, file_id, caption=full_caption, exclude_user=user_id)
+    # Если медиа: части альбома копим, остальное рассылаем сразу
+    media = extract_media(update.message)
+    if media:
+        kind, file_id = media
+        caption = update.message.caption or ""
+        group_id = update.message.media_group_id
+        # Медиа не склеить — сверх лимита отказываем; альбом считается одним сообщением
+        if group_id not in albums.albums:
+            wait = flood_guard.check(user_id, "chat")
+            if wait:
+                await flood_guard.warn(update, wait)
+                return
+        caption, verdict = await screen_text(update, user_id, caption)
+        if verdict and verdict.action == "hold":
+            await hold_message(update, user_id, verdict, kind=kind, file_id=file_id, caption=caption)
+            return
+        if group_id and kind in ALBUM_INPUTS:
+            albums.add(user_id, group_id, kind, file_id, caption)
+        else:
+            post = reply_map.new_post(user_id, chat_id, update.message.message_id)
+            broadcast_media(user_id, kind, file_id, caption, post)
         update_last_activity(user_id)
         return
 
     # Иначе текст
-    text = update.message.text.strip()
+    text, verdict = await screen_text(update, user_id, update.message.text.strip())
     replied_nick = ""
-    if update.message.reply_to_message and update.message.reply_to_message.from_user.id == context.application.bot.id:
-        replied_nick = parse_replied_nickname(update.message.reply_to_message.text)
-
+    kinds = None
+    reply_to = None
+    reply = update.message.reply_to_message
+    target = reply_map.lookup(chat_id, reply.message_id) if reply else None
+    if target:
+        # Автор известен по карте ответов: ник актуальный, ответ ляжет на копию у каждого
+        author_id, reply_to = target
+        replied_nick = (users_in_chat.get(author_id) or users_history.get(author_id, {})).get("nickname", "")
+        if author_id in users_in_chat and author_id != user_id:
+            kinds = {author_id: "reply"}
+    elif reply and reply.from_user.id == context.application.bot.id:
+        # Сообщение старше карты (например, до рестарта) — разбираем ник из текста
+        replied_nick = parse_replied_nickname(reply.text or "")
+        if replied_nick:
+            kinds = {
+                uid: "reply" for uid in user_registry.search(replied_nick)
+                if users_in_chat[uid]["nickname"] == replied_nick
+            }
     if text.startswith("%"):
         # Третье лицо
         out_text = text[1:].lstrip()
@@ -885,27 +3820,99 @@ async def anonymous_message(update: Update, context: ContextTypes.DEFAULT_TYPE):
             final_text = f"{nickname} (reply to {replied_nick}) {out_text}"
         else:
             final_text = f"{nickname} {out_text}"
-        await broadcast_text(context.application, final_text, exclude_user=user_id)
     else:
         # Обычное сообщение
         if replied_nick:
             final_text = f"{nickname} (reply to {replied_nick}): {text}"
         else:
             final_text = f"{nickname}: {text}"
-        await broadcast_text(context.application, final_text, exclude_user=user_id)
-
     update_last_activity(user_id)
+    if verdict and verdict.action == "hold":
+        # Задержанное тратит тот же лимит, что и обычное сообщение (в склейку не идёт)
+        wait = flood_guard.check(user_id, "chat")
+        if wait:
+            await flood_guard.warn(update, wait)
+            return
+        await hold_message(update, user_id, verdict, text=final_text)
+        return
+
+    # Сверх лимита (или пока копится склейка) — в склейку, иначе отказ
+    room = room_of(user_id)
+    merging = user_id in chat_merger.pending
+    wait = 0.0 if merging else flood_guard.check(user_id, "chat")
+    if merging or wait:
+        if not FLOOD_MERGE:
+            await flood_guard.warn(update, wait)
+            return
+        elif merging:
+            if not chat_merger.add(user_id, final_text, wait):
+                THROTTLED["chat"].inc()
+                await flood_guard.warn(update, 1 / FLOOD_RATE)
+                return
+        else:
+            post = reply_map.new_post(user_id, chat_id, update.message.message_id)
+            chat_merger.add(user_id, final_text, wait, room=room, post=post,
+                            reply_to=reply_to, kinds=kinds)
+    else:
+        post = reply_map.new_post(user_id, chat_id, update.message.message_id)
+        await broadcast_text(context.application, final_text, exclude_user=user_id, kinds=kinds,
+                             post=post, reply_to=reply_to, room=room)
+    room_history[room].add(final_text)
+
+
+# ------------------------------------------------------------------------
+# 15.1) МОДЕРАЦИЯ: решения по задержанным сообщениям
+# ------------------------------------------------------------------------
+async def moderation_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    query = update.callback_query
+    user_id = update.effective_user.id
+    if user_id not in admin_ids and user_id not in moderator_ids:
+        await query.answer("Только для модераторов.")
+        return
+    parts = query.data.split("|")
+    if len(parts) != 3 or parts[1] not in ("ok", "no") or not parts[2].isdigit():
+        await query.answer("Ошибка.")
+        return
+
+    item = held_messages.take(int(parts[2]))
+    if item is None:
+        await query.answer("Уже решено другим модератором.")
+        return
+    sender = users_in_chat.get(item["sender"])
+    if parts[1] == "ok":
+        if "text" in item:
+            await broadcast_text(context.application, item["text"], exclude_user=item["sender"], room=item["room"])
+            room_history[item["room"]].add(item["text"])
+        elif "poll" in item:
+            if sender:
+                publish_poll(item["sender"], item["room"], item["poll"])
+        elif "nick" in item:
+            if sender:
+                await apply_nick(context.application, item["sender"], item["nick"])
+        elif sender:
+            broadcast_media(item["sender"], item["kind"], item["file_id"], item["caption"])
+        verdict, notice = "✅ Пропущено", "[BOT] Твоё сообщение прошло проверку и отправлено в чат."
+    else:
+        verdict, notice = "❌ Удалено", "[BOT] Твоё сообщение не прошло проверку модератора."
+    if sender:
+        outbox.enqueue(sender["chat_id"], "send_message", label=sender["nickname"], text=notice)
+    try:
+        await query.message.edit_text(f"{query.message.text}\n\n{verdict}")
+    except BadRequest:
+        pass
+    await query.answer(verdict)
 
 
 # ------------------------------------------------------------------------
 # 16) УСТАНОВКА КОМАНД ДЛЯ МЕНЮ, post_init
 # ------------------------------------------------------------------------
-async def set_bot_commands(telegram_app):
-    commands = [
+BOT_COMMANDS = [
         BotCommand("start", "Войти в чат"),
         BotCommand("stop", "Выйти из чата"),
         BotCommand("nick", "Сменить ник"),
         BotCommand("list", "Список пользователей"),
+        BotCommand("last", "Недавние сообщения"),
+        BotCommand("room", "Сменить комнату"),
         BotCommand("msg", "Отправить ЛС"),
         BotCommand("getmsg", "Получить ЛС"),
         BotCommand("hug", "Обнять"),
@@ -917,23 +3924,70 @@ async def set_bot_commands(telegram_app):
         BotCommand("rules", "Правила чата"),
         BotCommand("about", "О боте"),
         BotCommand("help", "Помощь"),
-    ]
-    await telegram_app.bot.set_my_commands(commands)
+]
+background_tasks = set()   # ссылки на фоновые задачи старта, чтобы их не собрал GC
+
+
+def commands_hash(bot_id: int) -> str:
+    payload = json.dumps([bot_id] + [[c.command, c.description] for c in BOT_COMMANDS])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+async def set_bot_commands(telegram_app):
+    """Меню /команд: вызываем set_my_commands, только если список (или бот) поменялся."""
+    digest = commands_hash(telegram_app.bot.id)
+    if bot_meta.get("commands_hash") == digest:
+        return
+    try:
+        await telegram_app.bot.set_my_commands(BOT_COMMANDS)
+    except Exception as e:
+        logging.warning(f"Не удалось установить команды бота: {e}")
+        return
+    bot_meta["commands_hash"] = digest
+    state_store.mark("bot_meta", "commands_hash")
 
 async def post_init(telegram_app):
-    await set_bot_commands(telegram_app)
+    outbox.start(telegram_app.bot, producer=SHARD_WORKERS > 0)
+    state_store.start()
+    digests.start()
+    poll_engine.arm()
+    # Меню команд не нужно для обработки апдейтов — не задерживаем им старт
+    task = asyncio.create_task(set_bot_commands(telegram_app))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    mark_startup("ready")
+
+async def post_stop(telegram_app):
+    """
+    Апдейты больше не принимаются. Всё, что копится в буферах, — в очередь,
+    и досылаем очередь не дольше SHUTDOWN_TIMEOUT, чтобы рассылка не оборвалась
+    на середине при редеплое.
+    """
+    albums.flush_all()
+    chat_merger.flush_all()
+    poll_edits.flush()
+    await digests.stop()
+    left = await outbox.drain(SHUTDOWN_TIMEOUT)
+    # Воркеров останавливаем здесь, пока HTTP-клиент бота ещё открыт: после
+    # Application.shutdown() отправки падали бы, а задания снимались из журнала.
+    await outbox.stop()
+    if left:
+        where = "потеряны (OUTBOX_DB=:memory:)" if OUTBOX_DB == ":memory:" else "остались в журнале"
+        logging.warning(f"Не успели отправить {left} сообщений до остановки — {where}.")
+
+async def post_shutdown(telegram_app):
+    await state_store.stop()
+    send_errors.close()
 
 
 # ------------------------------------------------------------------------
 # 17) ГЛАВНАЯ ФУНКЦИЯ
 # ------------------------------------------------------------------------
-def main():
-    # Запускаем Flask (keep-alive) в фоновом потоке
-    keep_alive()
-
-    # Создаём Telegram-приложение
-    bot_app = ApplicationBuilder().token(BOT_TOKEN).build()
-    logging.info("Бот запускается...")
+def build_application():
+    """Telegram-приложение со всеми хендлерами."""
+    builder = ApplicationBuilder().token(BOT_TOKEN)
+    if TELEGRAM_BASE_URL:
+        builder = builder.base_url(TELEGRAM_BASE_URL)
+    bot_app = builder.build()
 
     # 1) Conversation /nick
     nick_conv_handler = ConversationHandler(
@@ -961,6 +4015,7 @@ def main():
         states={
             MSG_SELECT_RECIPIENT: [
                 CallbackQueryHandler(msg_callback_select_recipient, pattern="^msg_select\\|"),
+                CallbackQueryHandler(msg_picker_page, pattern="^msgp\\|"),
                 CallbackQueryHandler(msg_callback_cancel, pattern="^msg_cancel$")
             ],
             MSG_ENTER_TEXT: [
@@ -976,6 +4031,7 @@ def main():
         states={
             HUG_SELECT: [
                 CallbackQueryHandler(hug_select_callback, pattern="^hug_select\\|"),
+                CallbackQueryHandler(hug_picker_page, pattern="^hugp\\|"),
                 CallbackQueryHandler(hug_cancel_callback, pattern="^hug_cancel$")
             ],
         },
@@ -988,6 +4044,12 @@ def main():
 
     bot_app.add_handler(nick_conv_handler)
     bot_app.add_handler(CommandHandler("list", list_users))
+    bot_app.add_handler(CommandHandler("last", last_command))
+    bot_app.add_handler(CallbackQueryHandler(list_page_callback, pattern="^list\\|"))
+    bot_app.add_handler(CallbackQueryHandler(last_page_callback, pattern="^last\\|"))
+    bot_app.add_handler(CallbackQueryHandler(moderation_callback, pattern="^mod\\|"))
+    bot_app.add_handler(CommandHandler("room", room_command))
+    bot_app.add_handler(CallbackQueryHandler(room_callback, pattern="^room\\|"))
     bot_app.add_handler(CommandHandler("help", help_command))
     bot_app.add_handler(CommandHandler("rules", rules))
     bot_app.add_handler(CommandHandler("about", about))
@@ -995,6 +4057,7 @@ def main():
 
     bot_app.add_handler(msg_conv_handler)
     bot_app.add_handler(CommandHandler("getmsg", getmsg_command))
+    bot_app.add_handler(CallbackQueryHandler(getmsg_page_callback, pattern="^getmsg\\|"))
 
     bot_app.add_handler(hug_conv_handler)
     bot_app.add_handler(CommandHandler("search", search_command))
@@ -1005,16 +4068,187 @@ def main():
     bot_app.add_handler(CommandHandler("notify", notify_command))
     bot_app.add_handler(CallbackQueryHandler(notify_callback, pattern="^notify\\|"))
 
-    bot_app.add_handler(CallbackQueryHandler(poll_vote_callback, pattern="^pollvote\\|"))
+    bot_app.add_handler(CallbackQueryHandler(poll_vote_callback, pattern="^(pv|pollvote)\\|"))
+
+    # Обработка сообщений (текст/медиа)
+    bot_app.add_handler(MessageHandler(
+        ~filters.COMMAND & (
+            filters.TEXT | filters.PHOTO | filters.VIDEO | filters.ANIMATION | filters.AUDIO
+            | filters.Document.ALL | filters.VOICE | filters.VIDEO_NOTE | filters.Sticker.ALL
+        ),
+        anonymous_message
+    ))
+
+    # Парковка неактивных
+    if bot_app.job_queue:
+        bot_app.job_queue.run_repeating(idle_sweep_job, interval=IDLE_BUCKET, first=IDLE_BUCKET)
+        bot_app.job_queue.run_repeating(trigger_reload_job, interval=TRIGGERS_RELOAD_INTERVAL,
+                                        first=TRIGGERS_RELOAD_INTERVAL)
+    else:
+        logging.warning("JobQueue недоступна (нужен python-telegram-bot[job-queue]) — парковки и перечитывания фраз фильтра не будет.")
 
-    # Обработка сообщений (текст/фото)
-    bot_app.add_handler(MessageHandler(~filters.COMMAND & (filters.TEXT | filters.PHOTO), anonymous_message))
+    # Время обработки и ошибки каждого хендлера — в /metrics
+    for group in bot_app.handlers.values():
+        instrument_handlers(group)
 
-    # post_init для установки /команд
+    # post_init — установка /команд и запуск очереди отправки; post_stop — досылка при SIGTERM
     bot_app.post_init = post_init
+    bot_app.post_stop = post_stop
+    bot_app.post_shutdown = post_shutdown
+    return bot_app
+
+
+async def run_webhook(bot_app):
+    """
+    Режим вебхука: один asyncio HTTP-сервер на PORT отдаёт и вебхук
+    Telegram (WEBHOOK_PATH), и health-check на «/» и метрики на «/metrics». Без Flask и потоков.
+    """
+    from webserver import HttpServer, Response
+
+    secret = WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    server = HttpServer("0.0.0.0", int(os.getenv("PORT", "8080")))
+
+    async def health(request):
+        return Response("Я жив!")
+
+    async def metrics_endpoint(request):
+        return Response(metrics.render(), content_type=METRICS_CONTENT_TYPE)
+
+    async def telegram_webhook(request):
+        token = request.headers.get("x-telegram-bot-api-secret-token", "")
+        if not hmac.compare_digest(token.encode(), secret.encode()):
+            return Response("forbidden", 403)
+        try:
+            data = json.loads(request.body)
+            # Валидный JSON, но не объект апдейта ([], 1, {}) — тоже 400, а не 500
+            update = Update.de_json(data, bot_app.bot) if isinstance(data, dict) else None
+        except (ValueError, TypeError, KeyError, AttributeError):
+            return Response("bad update", 400)
+        if update is None:
+            return Response("bad update", 400)
+        await bot_app.update_queue.put(update)
+        return Response("ok")
+
+    server.route("GET", "/", health)
+    server.route("GET", "/metrics", metrics_endpoint)
+    server.route("POST", WEBHOOK_PATH, telegram_webhook)
+
+    stop_event = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop_event.set)
+        except NotImplementedError:
+            pass
+
+    await bot_app.initialize()
+    try:
+        if bot_app.post_init:
+            await bot_app.post_init(bot_app)
+        await server.start()
+        await bot_app.bot.set_webhook(
+            url=WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=secret,
+            allowed_updates=Update.ALL_TYPES
+        )
+        await bot_app.start()
+        logging.info(f"Вебхук: {WEBHOOK_URL.rstrip('/')}{WEBHOOK_PATH}")
+        await stop_event.wait()
+    finally:
+        await server.stop()
+        if bot_app.running:
+            await bot_app.stop()
+        if bot_app.post_stop:
+            await bot_app.post_stop(bot_app)
+        await bot_app.shutdown()
+        if bot_app.post_shutdown:
+            await bot_app.post_shutdown(bot_app)
+
+
+def run_delivery_shard(shard: int, shards: int):
+    """
+    Процесс-доставщик: отправляет задания из общего журнала OUTBOX_DB
+    для чатов с abs(chat_id) % shards == shard. Лимит на бота делится поровну.
+    """
+    async def serve():
+        stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+
+        bot = Bot(
+            BOT_TOKEN,
+            base_url=TELEGRAM_BASE_URL or "https://api.telegram.org/bot",
+            request=HTTPXRequest(connection_pool_size=SEND_WORKERS)
+        )
+        async with bot:
+            worker = Outbox(SEND_WORKERS, SEND_GLOBAL_RATE / shards, SEND_CHAT_RATE)
+            worker.start(bot, shard=(shard, shards))
+            logging.info(f"Доставщик {shard + 1}/{shards} запущен (pid {os.getpid()}).")
+            await stop_event.wait()
+            left = await worker.drain(SHUTDOWN_TIMEOUT)
+            if left:
+                logging.warning(f"Доставщик {shard + 1}/{shards}: {left} сообщений остались в журнале.")
+            await worker.stop()
+            send_errors.close()
+
+    # Свой файл лога: ротация одного файла из нескольких процессов небезопасна
+    base, ext = os.path.splitext(LOG_FILE)
+    setup_logging(f"{base}.delivery{shard}{ext}")
+    asyncio.run(serve())
+
+def start_delivery_shards(shards: int) -> list:
+    import multiprocessing
+
+    ctx = multiprocessing.get_context("spawn")
+    procs = [
+        ctx.Process(target=run_delivery_shard, args=(k, shards), name=f"delivery-{k}", daemon=True)
+        for k in range(shards)
+    ]
+    for p in procs:
+        p.start()
+    return procs
+
+
+def main():
+    if not BOT_TOKEN:
+        raise ValueError("No token_an found in environment variables!")
+    setup_logging()
+
+    # Поднимаем сохранённое состояние и фильтр триггеров до приёма апдейтов
+    restore_state()
+    trigger_filter.load()
+
+    bot_app = build_application()
+    logging.info(f"Бот запускается ({BOT_MODE})...")
+
+    # Многопроцессная доставка: этот процесс принимает апдейты, доставщики шлют
+    shard_procs = []
+    if SHARD_WORKERS:
+        if OUTBOX_DB == ":memory:":
+            raise ValueError("SHARD_WORKERS requires a file OUTBOX_DB!")
+        shard_procs = start_delivery_shards(SHARD_WORKERS)
 
-    # Запуск
-    bot_app.run_polling()
+    try:
+        if BOT_MODE == "webhook":
+            if not WEBHOOK_URL:
+                raise ValueError("BOT_MODE=webhook requires WEBHOOK_URL!")
+            asyncio.run(run_webhook(bot_app))
+            return
+
+        # Polling: Flask (keep-alive) в фоновом потоке. SIGTERM/SIGINT останавливают
+        # приём апдейтов, затем post_stop досылает очередь
+        server = keep_alive()
+        try:
+            bot_app.run_polling()
+        finally:
+            server.shutdown()
+    finally:
+        # Доставщики по SIGTERM досылают свою очередь
+        for p in shard_procs:
+            p.terminate()
+        for p in shard_procs:
+            p.join(SHUTDOWN_TIMEOUT + 2)
 
 
 # ------------------------------------------------------------------------
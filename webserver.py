@@ -0,0 +1,141 @@
+"""
+Минимальный HTTP/1.1 сервер на asyncio — без Flask и без отдельного потока.
+Используется ботом в режиме вебхука (вебхук + health-check на одном порту)
+и фейковым Telegram API в fake_telegram.py.
+"""
+import asyncio
+import logging
+from urllib.parse import urlsplit, parse_qsl
+
+
+MAX_BODY = 1024 * 1024       # Telegram шлёт апдейты намного меньше
+READ_TIMEOUT = 30.0
+
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    403: "Forbidden",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    429: "Too Many Requests",
+    500: "Internal Server Error",
+}
+
+
+class Request:
+    __slots__ = ("method", "path", "query", "headers", "body")
+
+    def __init__(self, method: str, path: str, query: dict, headers: dict, body: bytes):
+        self.method = method
+        self.path = path
+        self.query = query
+        self.headers = headers   # ключи в нижнем регистре
+        self.body = body
+
+
+class Response:
+    __slots__ = ("status", "body", "content_type")
+
+    def __init__(self, body="", status: int = 200, content_type: str = "text/plain; charset=utf-8"):
+        self.status = status
+        self.body = body.encode("utf-8") if isinstance(body, str) else body
+        self.content_type = content_type
+
+
+class HttpServer:
+    """
+    Маршруты: (метод, путь) -> async handler(request) -> Response.
+    Поддерживает keep-alive и тело по Content-Length (без chunked).
+    """
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self.routes = {}
+        self.server = None
+        self.connections = set()
+
+    def route(self, method: str, path: str, handler):
+        self.routes[(method.upper(), path)] = handler
+
+    async def start(self):
+        self.server = await asyncio.start_server(self._serve, self.host, self.port)
+        if not self.port:
+            self.port = self.server.sockets[0].getsockname()[1]
+        logging.info(f"HTTP-сервер слушает {self.host}:{self.port}")
+
+    async def stop(self):
+        if self.server is None:
+            return
+        self.server.close()
+        for writer in list(self.connections):
+            writer.close()
+        await self.server.wait_closed()
+        self.server = None
+
+    async def _read_request(self, reader):
+        line = await reader.readline()
+        if not line:
+            return None
+        try:
+            method, target, _version = line.decode("latin-1").split()
+        except ValueError:
+            return Response("bad request line", 400)
+        headers = {}
+        while True:
+            raw = await reader.readline()
+            if raw in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = raw.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get("content-length") or 0)
+        if length > MAX_BODY:
+            return Response("payload too large", 413)
+        body = await reader.readexactly(length) if length else b""
+        url = urlsplit(target)
+        return Request(method.upper(), url.path, dict(parse_qsl(url.query)), headers, body)
+
+    async def _dispatch(self, request: Request) -> Response:
+        handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            if any(path == request.path for _, path in self.routes):
+                return Response("method not allowed", 405)
+            return Response("not found", 404)
+        try:
+            return await handler(request)
+        except Exception as e:
+            logging.warning(f"Ошибка обработки {request.method} {request.path}: {e}")
+            return Response("internal error", 500)
+
+    async def _serve(self, reader, writer):
+        self.connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await asyncio.wait_for(self._read_request(reader), READ_TIMEOUT)
+                except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+                    break
+                if request is None:
+                    break
+                keep_alive = True
+                if isinstance(request, Response):
+                    response, keep_alive = request, False
+                else:
+                    response = await self._dispatch(request)
+                    keep_alive = request.headers.get("connection", "").lower() != "close"
+                head = (
+                    f"HTTP/1.1 {response.status} {REASONS.get(response.status, '')}\r\n"
+                    f"Content-Type: {response.content_type}\r\n"
+                    f"Content-Length: {len(response.body)}\r\n"
+                    f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                )
+                writer.write(head.encode("latin-1") + response.body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self.connections.discard(writer)
+            writer.close()